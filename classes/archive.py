@@ -0,0 +1,362 @@
+import json, base64, gzip, io, zlib, codecs, http.client
+from classes.request import PageFetcher
+
+# wig - Archive
+#
+# Fills the cache with the responses in a HAR or WARC file, such that a
+# site can be fingerprinted from captured traffic without making any
+# requests (see requester_offline.py).
+# The archives are read one entry at a time, so only the current entry
+# is kept in memory while reading. The bodies in the cache are kept
+# within the cache's memory budget.
+#
+# The readers yield (url, status, reason, headers, body) tuples, where
+# 'headers' is a list of (name, value) pairs and 'body' is bytes.
+
+
+class HarReader(object):
+	# reads the entries of a HAR file without loading the whole file.
+	# Only the 'log' object and its 'entries' array are parsed one value
+	# at a time; every other value is parsed whole and skipped
+
+	def __init__(self, file_name, chunk_size=1024*1024):
+		self.file_name = file_name
+		self.chunk_size = chunk_size
+		self.decoder = json.JSONDecoder()
+
+
+	def _read(self, size=None):
+		# read the next chunk of the file. Returns False at the end
+		chunk = self.file.read(size or self.chunk_size)
+		if not chunk:
+			return False
+
+		# drop the part of the buffer that has been parsed
+		self.buffer = self.buffer[self.pos:] + chunk
+		self.pos = 0
+		return True
+
+
+	def _peek(self):
+		# returns the next non-whitespace character
+		while True:
+			while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+				self.pos += 1
+
+			if self.pos < len(self.buffer):
+				return self.buffer[self.pos]
+
+			if not self._read():
+				raise ValueError('Unexpected end of HAR file')
+
+
+	def _expect(self, char):
+		if not self._peek() == char:
+			raise ValueError('Invalid HAR file: expected %s' % (char, ))
+		self.pos += 1
+
+
+	def _decode(self):
+		# decode the next JSON value. If the value might continue in
+		# the part of the file that has not been read yet, more is read.
+		# The amount to read is doubled every time, so large values are
+		# not parsed over and over again
+		self._peek()
+		size = self.chunk_size
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buffer, self.pos)
+				if end < len(self.buffer):
+					self.pos = end
+					return value
+			except ValueError:
+				pass
+
+			if not self._read(size):
+				break
+			size *= 2
+
+		value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+		return value
+
+
+	def _keys(self):
+		# yields the keys of the object being parsed. The value of
+		# each key must be parsed before asking for the next key
+		self._expect('{')
+		while True:
+			char = self._peek()
+			if char == '}':
+				self.pos += 1
+				return
+
+			if char == ',':
+				self.pos += 1
+
+			key = self._decode()
+			self._expect(':')
+			yield key
+
+
+	def _entries(self):
+		self._expect('[')
+		while True:
+			char = self._peek()
+			if char == ']':
+				self.pos += 1
+				return
+
+			if char == ',':
+				self.pos += 1
+				continue
+
+			entry = self._get_response(self._decode())
+			if entry is not None:
+				yield entry
+
+
+	def _get_response(self, entry):
+		# entries that are not complete are skipped
+		try:
+			return self._parse_entry(entry)
+		except (KeyError, TypeError, ValueError, AttributeError):
+			return None
+
+
+	def _parse_entry(self, entry):
+		response = entry['response']
+
+		# entries without a response (e.g. blocked requests) have status 0
+		status = response['status']
+		if status == 0:
+			return None
+
+		# HTTP/2 pseudo headers are not headers
+		headers = [(h['name'], h['value']) for h in response.get('headers', []) if not h['name'].startswith(':')]
+
+		content = response.get('content', {})
+		text = content.get('text', '')
+		if content.get('encoding') == 'base64':
+			body = base64.b64decode(text)
+		else:
+			body = text.encode(self._get_charset(content.get('mimeType', '')), errors='replace')
+
+		return entry['request']['url'], status, response.get('statusText', ''), headers, body
+
+
+	def _get_charset(self, mime_type):
+		# text bodies are encoded with the charset they were sent with
+		for item in mime_type.split(';'):
+			if 'charset' in item:
+				charset = item.split('=')[1].strip()
+				try:
+					return codecs.lookup(charset).name
+				except LookupError:
+					break
+
+		return 'utf-8'
+
+
+	def __iter__(self):
+		with open(self.file_name, encoding='utf-8-sig') as self.file:
+			self.buffer = ''
+			self.pos = 0
+
+			for key in self._keys():
+				if not key == 'log':
+					self._decode()
+					continue
+
+				for key in self._keys():
+					if key == 'entries':
+						yield from self._entries()
+					else:
+						self._decode()
+
+
+
+class WarcReader(object):
+	# reads the response records of a WARC file, which might be
+	# compressed with gzip (.warc.gz). The records are read one by one
+
+	def __init__(self, file_name):
+		self.file_name = file_name
+
+
+	def _open(self):
+		with open(self.file_name, 'rb') as f:
+			is_gzip = f.read(2) == b'\x1f\x8b'
+
+		return gzip.open(self.file_name, 'rb') if is_gzip else open(self.file_name, 'rb')
+
+
+	def _get_response(self, block):
+		# parse a HTTP response. http.client takes care of the
+		# transfer encoding, but the content encoding is left as is
+		# in the capture
+		class Socket(object):
+			def makefile(self, mode):
+				return io.BytesIO(block)
+
+		r = http.client.HTTPResponse(Socket())
+		r.begin()
+		body = r.read()
+		headers = r.getheaders()
+
+		encoding = (r.getheader('Content-Encoding') or '').lower()
+		if encoding in ('gzip', 'x-gzip'):
+			body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+		elif encoding == 'deflate':
+			try:
+				body = zlib.decompress(body)
+			except zlib.error:
+				body = zlib.decompress(body, -zlib.MAX_WBITS)
+
+		return r.status, r.reason, headers, body
+
+
+	def _read_headers(self, f):
+		# the headers of a record end at an empty line. Lines that are
+		# not headers are skipped
+		headers = {}
+		for line in iter(f.readline, b''):
+			line = line.decode('utf-8', errors='replace').strip()
+			if line == '':
+				break
+
+			if ':' in line:
+				name, value = line.split(':', 1)
+				headers[name.strip().lower()] = value.strip()
+
+		return headers
+
+
+	def __iter__(self):
+		with self._open() as f:
+			first = True
+			for line in iter(f.readline, b''):
+				# records are separated by empty lines. The block of a
+				# record without a valid length cannot be skipped, so
+				# the lines up to the next record are skipped instead
+				if not line.startswith(b'WARC/'):
+					if first and line.strip():
+						raise ValueError('Invalid WARC file')
+					continue
+
+				first = False
+				headers = self._read_headers(f)
+				try:
+					block = f.read(int(headers['content-length']))
+				except (KeyError, ValueError):
+					continue
+
+				if not headers.get('warc-type') == 'response': continue
+				if not 'application/http' in headers.get('content-type', ''): continue
+				if not 'warc-target-uri' in headers: continue
+
+				try:
+					status, reason, response_headers, body = self._get_response(block)
+				except (http.client.HTTPException, zlib.error, ValueError):
+					continue
+
+				url = headers['warc-target-uri'].strip('<>')
+				yield url, status, reason, response_headers, body
+
+
+
+def open_archive(file_name):
+	# returns the reader for the archive: HAR files are JSON, WARC
+	# files start with the WARC version (and might be compressed)
+	with open(file_name, 'rb') as f:
+		start = f.read(3)
+
+	if start.startswith(b'{') or start.startswith(b'\xef\xbb\xbf') or file_name.endswith('.har'):
+		return HarReader(file_name)
+	else:
+		return WarcReader(file_name)
+
+
+
+class ArchiveLoader(object):
+	# fill the cache with the responses in the archive for the host
+
+	def __init__(self, options, data):
+		self.file_name = options['archive']
+		self.host = options['host']
+		self.max_body_size = options['max_body_size']
+		self.cache = data['cache']
+		self.printer = options['printer']
+
+
+	def run(self):
+		self.printer.print('Loading archive %s...' % (self.file_name, ), 1)
+
+		# the fetcher is only used to parse the URLs, and to create
+		# the responses in the same way as when they are requested
+		fetcher = PageFetcher(self.host, max_body_size=self.max_body_size)
+
+		# the responses that redirect are kept apart, and are replaced by 
+		# the response they end up at, as when the redirects are followed
+		# by the requester
+		redirects = {}
+		count = 0
+		try:
+			for url, status, reason, headers, body in open_archive(self.file_name):
+				# skip responses for other hosts, and responses that
+				# do not have the full body
+				protocol, host, path, in_scope = fetcher.get_parts(url)
+				if not in_scope or status == 304 or status < 200:
+					continue
+
+				response_body = fetcher.create_body(headers)
+				response_body.add(body)
+				response = fetcher.create_request(protocol, host, path, status, reason, headers, response_body)
+
+				if 300 <= status < 400:
+					redirects[response.get_url()] = response
+				else:
+					self.cache[response.get_url()] = response
+
+				count += 1
+
+		except (OSError, EOFError, ValueError, zlib.error) as e:
+			print('Error reading archive: ' + str(e))
+			return False
+
+		for url, response in redirects.items():
+			history = self._follow(fetcher, redirects, response)
+			if history is None:
+				continue
+
+			final = history[-1]
+			final.history = history[:-1]
+			for r in history:
+				self.cache[r.get_url()] = final
+
+		self.printer.print('- Loaded %s responses' % (count, ), 2)
+		return True
+
+
+	def _follow(self, fetcher, redirects, response):
+		# returns the responses from the redirect to the response it ends
+		# up at, or None if that response is not in the archive, as the
+		# request for the URL would have failed
+		history = [response]
+		while len(history) <= fetcher.max_redirs:
+			redirect = fetcher.get_redirect(history[-1])
+			if redirect is None:
+				break
+
+			# a redirect loop ends at the last response before the loop
+			target = '%s://%s%s' % redirect
+			if target in redirects:
+				if redirects[target] in history:
+					break
+				history.append(redirects[target])
+			elif target in self.cache:
+				history.append(self.cache[target])
+				break
+			else:
+				return None
+
+		return history
@@ -1,166 +1,404 @@
-import queue, pickle, os, time, hashlib, re
+import queue, pickle, os, time, sqlite3, hashlib, zlib, copy, tempfile, threading
+from collections import OrderedDict
 
 # wig - Cache
 #
-# wig uses a cache to store the requests and responses made during a scan. 
-# This helps limit the amount of requests that it makes, as a request for 
+# wig uses a cache to store the requests and responses made during a scan.
+# This helps limit the amount of requests that it makes, as a request for
 # resource is only made once.
-# To further limit the amount of requests, wig saves a copy of the cache
-# and will reuse it for scans run within 24 hours.
+# To further limit the amount of requests, wig saves the responses in a
+# SQLite database, and reuses them in later scans of the same host until
+# they expire (by default after 24 hours).
 #
-# NOTE: The pickle module is used to save and load the cache. This has the
-#       side effect, that the extra variables which are added to a an 
-#       instance of Requests are not kept. Currently 2 variables are added:
-#       md5 and md5_404. These values have to be recalculated when loading 
-#       a pickled cache. Ideally, a custom object should be created for 
-#       the modified requests, so this is on the TODO.
+# The responses of the current scan are kept in memory. When saving is
+# enabled, every response is written to the database as soon as it is
+# added, so the responses of a scan that crashes or is interrupted are
+# not lost. When loading is enabled, a URL that is not in memory is
+# looked up in the database, so only the responses that are actually
+# used are loaded.
+# The database uses write-ahead logging, so several wig processes can
+# use the same cache at the same time.
+#
+# Expired responses that have an ETag or Last-Modified header are kept
+# for 'stale_ttl' seconds more. When such a URL is requested again, 
+# the requester asks the server if the response has changed, and 
+# reuses the cached response if it has not (see 'get_stale').
+#
+# The bodies are stored separately from the responses, keyed by their
+# content hash, so a body that is served at several URLs (e.g. soft 404s
+# or default pages) is only kept once in memory and once on disk. On 
+# disk, the bodies are compressed with zlib if 'compress' is set.
+#
+# NOTE: The responses are pickled without their bodies. The decoded body
+#       of a response is not stored, as it is recreated from the raw body
+#       when needed.
+
+
+# the version of the database layout. Caches with another version are
+# discarded
+SCHEMA_VERSION = 3
+
+
+class BodyStore(object):
+	# Keeps the bodies of the responses in the cache, keyed by their 
+	# content hash, along with the bodies decoded to strings.
+	# At most 'max_size' bytes of bodies are kept in memory (if set). When
+	# the limit is reached, the least recently used bodies are written to
+	# a temporary file, and read back when they are needed again. Decoded 
+	# bodies are not written to the file, but decoded again.
+
+	def __init__(self, max_size=None):
+		self.max_size = max_size
+		self.size = 0
+		self.lock = threading.Lock()
+		self.memory = OrderedDict()		# key or (key, encoding) -> body
+		self.spilled = {}				# key -> (offset, length)
+		self.spill_file = None
+
+
+	def __contains__(self, key):
+		with self.lock:
+			return key in self.memory or key in self.spilled
+
+
+	def add(self, key, body):
+		# returns False if the body is already in the store
+		with self.lock:
+			if key in self.memory or key in self.spilled:
+				return False
+
+			self._keep(key, body)
+			return True
+
+
+	def get(self, key):
+		with self.lock:
+			if key in self.memory:
+				self.memory.move_to_end(key)
+				return self.memory[key]
+
+			offset, length = self.spilled[key]
+			self.spill_file.seek(offset)
+			body = self.spill_file.read(length)
+			self._keep(key, body)
+
+			return body
+
+
+	def get_decoded(self, key, encoding):
+		with self.lock:
+			if (key, encoding) in self.memory:
+				self.memory.move_to_end((key, encoding))
+				return self.memory[(key, encoding)]
+
+		body = str(self.get(key), encoding, errors='replace')
+		with self.lock:
+			if not (key, encoding) in self.memory:
+				self._keep((key, encoding), body)
+
+		return body
+
+
+	def _keep(self, key, body):
+		# add a body to memory, and make room for it
+		self.memory[key] = body
+		self.size += len(body)
+		if self.max_size is None: return
+
+		# the body that was just added is never evicted
+		while self.size > self.max_size and len(self.memory) > 1:
+			old_key, old_body = self.memory.popitem(last=False)
+			self.size -= len(old_body)
+
+			# raw bodies are written to the file the first time they 
+			# are evicted
+			if isinstance(old_body, bytes) and not old_key in self.spilled:
+				if self.spill_file is None:
+					self.spill_file = tempfile.TemporaryFile()
+
+				self.spill_file.seek(0, os.SEEK_END)
+				self.spilled[old_key] = (self.spill_file.tell(), len(old_body))
+				self.spill_file.write(old_body)
+
+
+	def set_max_size(self, max_size):
+		with self.lock:
+			self.max_size = max_size
+
 
 
 class Cache(queue.Queue):
 	def _init(self, maxsize):
 		self.queue = dict()
+		self.responses = dict()		# response id -> response
+		self.bodies = BodyStore()	# content hash -> body
 		self.host = None
 		self.cache_dir = './cache/'
-		self.now = str(time.time()).split('.')[0]
+		self.db_name = 'wig.db'
+		self.db = None
+		self.load_enabled = False
+		self.save_enabled = False
+		self.compress = True
 
-		# only load cache data that is new than this
+		# the default time to live for cache entries
 		# (currently this is set for 24 hours)
 		self.cache_ttl = 60*60*24
 
-		# check if there are caches that are older than ttl
-		self._remove_old_caches()
+		# expired entries that can be revalidated are kept this much
+		# longer (currently 30 days)
+		self.stale_ttl = 60*60*24*30
 
+		# the ids of the responses that have been written to the database
+		self.saved = set()
 
-	def __getitem__(self, path):
-		return self.queue[path]
 
-
-	def __setitem__(self, path, response):
+	def __getitem__(self, url):
 		with self.mutex:
-			self.queue[path] = response
+			if url in self.queue:
+				return self.queue[url]
+
+			response = self._load(url)
+			if response is None:
+				raise KeyError(url)
+
+			return response
+
+
+	def __setitem__(self, url, response):
+		self.set(url, response)
 
 
 	def __contains__(self, url):
 		with self.mutex:
-			return url in self.queue
+			return url in self.queue or self._load(url) is not None
 
 
-	def _remove_old_caches(self):
-		# remove caches that are too old
-		
-		# bail if the directory does not exist
-		if not os.path.exists(self.cache_dir): return None
+	def _get_body_key(self, response):
+		# the md5 of a response is calculated over the full body, so
+		# it can only be used as key if all of the body was kept
+		if response.truncated or response.dropped:
+			return hashlib.md5(response.content).hexdigest()
 
-		# iterate over the cache files
-		for cache_file in os.listdir(self.cache_dir):
-			
-			# skip the file if it's not a cache file
-			if not cache_file.endswith('.cache'):
-				continue
-
-			# check if the cache is for the host
-			hostname, time_ext = cache_file.split('_-_')
-			save_time,_ = time_ext.split('.')
-
-			# check the age of the cache, and remove it if older than
-			# ttl
-			age = int(self.now) - int(save_time)
-			if age > self.cache_ttl:
-				file_name = os.path.join(self.cache_dir, cache_file)
-				os.remove(file_name)
-
-
-	def _get_name_for_cache_file(self):
-		# check if there already is an older version of the cache
-		# if there is, return the name of this file, such that,
-		# it will be overwritten
-		if not os.path.exists(self.cache_dir):
-			os.makedirs(self.cache_dir)
+		return response.md5
 
-		for cache_file in os.listdir(self.cache_dir):
-			# skip the file if it's not a cache file
-			if not cache_file.endswith('.cache'):
-				continue
-			
-			# check if the cache is for the host
-			hostname,_ = cache_file.split('_-_')
-			if hostname == self.cache_name.split('_-_')[0]:
-				return os.path.join(self.cache_dir, cache_file)
 
-		# if there aren't any previous cache files, generate a 
-		# new name for the cache
-		return os.path.join(self.cache_dir, self.cache_name)
+	def _dump(self, response):
+		# pickle a response without its body
+		stripped = copy.copy(response)
+		stripped.content = b''
+		return pickle.dumps(stripped)
 
 
-	def set_host(self, host):
-		self.host = host
-		self.cache_name = self.host.replace('/','').replace(':','..') + '_-_' + self.now + '.cache'
+	def _compress(self, body):
+		# returns the body to store, and whether it is compressed.
+		# Bodies that do not compress well (e.g. images) are stored as is
+		if self.compress:
+			compressed = zlib.compress(body)
+			if len(compressed) < len(body):
+				return compressed, True
 
+		return body, False
 
-	def get_num_urls(self):
-		return len(set([self.queue[key].id for key in self.queue]))
 
+	def set(self, url, response, ttl=None):
+		# add the response for a URL. The entry expires after 'ttl'
+		# seconds, or after 'cache_ttl' seconds if 'ttl' is not set
+		expires = time.time() + (self.cache_ttl if ttl is None else ttl)
+		key = self._get_body_key(response)
 
-	def get_responses(self):
-		return [self.queue[key] for key in self.queue]
-
-
-	def save(self):
-		# save the queue for later use
-		# this will help limit the amount of requests made
-		# when scanning the same site multiple times
-		with self.mutex:		
-			file_name = self._get_name_for_cache_file()
-			with open(file_name, 'wb') as cache_file:
-				try:
-					pickle.dump(self.queue, cache_file)
-				except:
-					print('Error saving cache: ' + file_name)
-	
-	def load(self):
-		# loads previously saved cache for the host
-
-		# bail if the host is not set
-		if self.host is None: return None
-
-		# search the cache dir
-		for cache_file in os.listdir(self.cache_dir):
+		# the response is pickled outside of the mutex, and only 
+		# once for all the URLs in its redirect history
+		data = None
+		if self.save_enabled and not response.id in self.saved:
+			data = self._dump(response)
 
-			# skip the file if it's not a cache file
-			if not cache_file.endswith('.cache'):
-				continue
+		# the validators of a response can only be used for the URL it
+		# was fetched from, not for the URLs that redirected to it
+		revalidate = not response.history and response.get_url() == url and len(response.get_validators()) > 0
 
-			# check if the cache is for the host
-			hostname, time_ext = cache_file.split('_-_')
-			save_time,_ = time_ext.split('.') 
+		with self.mutex:
+			self.queue[url] = response
+			self.responses[response.id] = response
+
+			# responses with the same body share it. The body is kept 
+			# by the store, which might move it out of memory
+			content = response.content
+			new_body = self.bodies.add(key, content)
+			response.set_store(self.bodies, key)
+
+			if not self.save_enabled: return
+			self.saved.add(response.id)
+
+			try:
+				with self.db:
+					if new_body:
+						body, compressed = self._compress(content)
+						self.db.execute('INSERT OR IGNORE INTO bodies (hash, compressed, body) VALUES (?, ?, ?)', (key, compressed, body))
+					if data is not None:
+						self.db.execute('INSERT OR REPLACE INTO responses (id, hash, response) VALUES (?, ?, ?)', (response.id, key, data))
+					self.db.execute('INSERT OR REPLACE INTO urls (host, url, id, expires, revalidate) VALUES (?, ?, ?, ?, ?)', (self.host, url, response.id, expires, revalidate))
+			except sqlite3.Error as e:
+				print('Error saving cache: ' + str(e))
+
+
+	def _load(self, url):
+		# look up a URL in the database and add the response to
+		# memory. Must be called with the mutex held
+		if not self.load_enabled: return None
+
+		try:
+			row = self.db.execute(
+				'SELECT responses.id, responses.hash, responses.response FROM urls JOIN responses ON urls.id = responses.id '
+				'WHERE urls.host = ? AND urls.url = ? AND urls.expires > ?', (self.host, url, time.time())
+			).fetchone()
+		except sqlite3.Error:
+			return None
+
+		if row is None: return None
+
+		# responses stored for several URLs are only loaded once
+		response_id, key, data = row
+		if not response_id in self.responses:
+			response = self._unpickle(key, data)
+			if response is None: return None
+
+			self.responses[response_id] = response
+
+		response = self.responses[response_id]
+		self.queue[url] = response
+		self.saved.add(response_id)
+
+		return response
+
+
+	def _unpickle(self, key, data):
+		try:
+			response = pickle.loads(data)
+			self._load_body(key)
+			response.set_store(self.bodies, key)
+		except Exception:
+			return None
+
+		return response
+
+
+	def get_stale(self, url):
+		# returns the expired response for a URL if it can be 
+		# revalidated, otherwise None. The response is not added to
+		# the cache, unless the server confirms that it has not 
+		# changed, and it is added again
+		with self.mutex:
+			if not self.load_enabled: return None
 
-			# calc the age of the cache
-			age = int(self.now) - int(save_time)
+			try:
+				row = self.db.execute(
+					'SELECT responses.id, responses.hash, responses.response FROM urls JOIN responses ON urls.id = responses.id '
+					'WHERE urls.host = ? AND urls.url = ? AND urls.revalidate = 1', (self.host, url)
+				).fetchone()
+			except sqlite3.Error:
+				return None
 
-			# overwrite the current queue if it's for the host and the cache is not too old
-			if hostname == self.cache_name.split('_-_')[0] and age < self.cache_ttl:
-				file_name = os.path.join(self.cache_dir, cache_file)
-				try:
-					with open(file_name, 'rb') as f:
-						data = pickle.load(f)
-						for path in data:
-							self.__setitem__(path, data[path])
-				except:
-					print('Error loading cache: ' +  file_name)
+			if row is None: return None
 
+			response_id, key, data = row
+			if response_id in self.responses:
+				return self.responses[response_id]
 
+			# the response is already in the database, so it is 
+			# not saved again if it is reused
+			response = self._unpickle(key, data)
+			if response is not None:
+				self.saved.add(response_id)
 
+			return response
 
 
+	def _load_body(self, key):
+		# bodies shared by several responses are only loaded once
+		if not key in self.bodies:
+			compressed, body = self.db.execute('SELECT compressed, body FROM bodies WHERE hash = ?', (key, )).fetchone()
+			self.bodies.add(key, zlib.decompress(body) if compressed else body)
 
 
+	def _remove_old_caches(self):
+		# remove the expired entries that cannot be revalidated, and the
+		# responses that are no longer used by any entry
+		with self.db:
+			now = time.time()
+			self.db.execute('DELETE FROM urls WHERE expires <= ? AND (revalidate = 0 OR expires <= ?)', (now, now - self.stale_ttl))
+			self.db.execute('DELETE FROM responses WHERE id NOT IN (SELECT id FROM urls)')
+			self.db.execute('DELETE FROM bodies WHERE hash NOT IN (SELECT hash FROM responses)')
+
+		# the pickled caches of older versions are not used anymore
+		for cache_file in os.listdir(self.cache_dir):
+			if cache_file.endswith('.cache'):
+				os.remove(os.path.join(self.cache_dir, cache_file))
+
+
+	def set_host(self, host):
+		self.host = host
 
 
+	def set_memory_budget(self, max_size):
+		# the max number of bytes of bodies to keep in memory.
+		# 'None' keeps all bodies in memory
+		self.bodies.set_max_size(max_size)
 
 
+	def open(self, load=True, save=True):
+		# open the database. If 'load' is set, responses are loaded from
+		# the database, and if 'save' is set, responses are written to it
+		if not (load or save): return
 
+		if not os.path.exists(self.cache_dir):
+			os.makedirs(self.cache_dir)
 
+		try:
+			# the connection is shared by the requester threads, and
+			# is guarded by the mutex. The timeout is how long to wait
+			# for other processes that are writing to the database
+			self.db = sqlite3.connect(os.path.join(self.cache_dir, self.db_name), timeout=30, check_same_thread=False)
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('PRAGMA synchronous=NORMAL')
+			with self.db:
+				# the cache is discarded if the layout has changed
+				version, = self.db.execute('PRAGMA user_version').fetchone()
+				if not version == SCHEMA_VERSION:
+					for table in ['urls', 'responses', 'bodies']:
+						self.db.execute('DROP TABLE IF EXISTS ' + table)
+					self.db.execute('PRAGMA user_version = %d' % (SCHEMA_VERSION, ))
+
+				self.db.execute('CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, compressed INTEGER NOT NULL, body BLOB NOT NULL)')
+				self.db.execute('CREATE TABLE IF NOT EXISTS responses (id TEXT PRIMARY KEY, hash TEXT NOT NULL, response BLOB NOT NULL)')
+				self.db.execute('CREATE TABLE IF NOT EXISTS urls (host TEXT NOT NULL, url TEXT NOT NULL, id TEXT NOT NULL, expires REAL NOT NULL, revalidate INTEGER NOT NULL, PRIMARY KEY (host, url))')
+				self.db.execute('CREATE INDEX IF NOT EXISTS urls_expires ON urls (expires)')
+
+			self._remove_old_caches()
+
+		except (sqlite3.Error, OSError) as e:
+			print('Error opening cache: ' + str(e))
+			self.db = None
+			return
+
+		self.load_enabled = load
+		self.save_enabled = save
+
+
+	def close(self):
+		with self.mutex:
+			self.load_enabled = False
+			self.save_enabled = False
+			if self.db is not None:
+				self.db.close()
+				self.db = None
 
 
+	def get_num_urls(self):
+		return len(self.responses)
 
 
+	def get_responses(self):
+		# a response is stored for every url in its redirect history,
+		# but should only be returned once
+		with self.mutex:
+			return list(self.responses.values())
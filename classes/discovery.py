@@ -4,23 +4,35 @@ from html.parser import HTMLParser
 from classes.fingerprints import Fingerprints
 from classes.requester2 import Requester
 from classes.matcher import Match
-from classes.request import PageFetcher, Request
+from classes.request import PageFetcher, Request, simhash_distance
 from classes.printer import Printer
+from classes.scheduler import ProbeScheduler, VersionScheduler
 
 
 class DiscoverRedirect(object):
 
-	def __init__(self, options):
+	def __init__(self, options, cache=None):
 		self.org = options['host']
 		self.url = options['host']
 		self.printer = options['printer']
 
 		self.printer.print('Redirection detection...', 1, '')
 
+		# the response is kept for passive detection
+		self.response = None
+
 		fetcher = PageFetcher(self.url)
 		try:
-			r = fetcher.get()
-			request_url = r.get_url() 
+			# if a cache is given, no request is made. If the URL is not
+			# in the cache, it is assumed that it does not redirect
+			if cache is None:
+				self.response = fetcher.get()
+				request_url = self.response.get_url() 
+			elif fetcher.url in cache:
+				self.response = cache[fetcher.url]
+				request_url = self.response.get_url()
+			else:
+				request_url = self.url
 
 			if not request_url == self.url:
 				# ensure that folders and files are removed
@@ -53,105 +65,262 @@ class DiscoverRedirect(object):
 	def get_valid_url(self):
 		return self.url
 
+	# the response for the input URL, or None if there is none
+	def get_response(self):
+		return self.response
+
 
 
 class DiscoverErrorPage(object):
 	# find error pages on the site
 	# the requester has a built-in list of items and patterns
 	# to remove before calculating a checksum of pages that
-	# should not exists
+	# should not exists.
+	# The URLs are requested a few at a time, and the detection stops
+	# when the last 'stable_after' responses did not show a new error
+	# page, as the site's error page behaviour is then known.
+	# If 'error_page_distance' is set, error pages are also compared by
+	# their simhash, so pages that only differ in a few places (e.g. 
+	# the requested path or a random token) count as the same error page
 
 	def __init__(self, options, data):
 		self.host = options['host']
 		self.urls = data['fingerprints'].get_error_urls()
 		self.error_pages = set()
+		self.error_simhashes = []
+		self.responses = []
+		self.distance = options['error_page_distance']
+		self.stable_after = 3
 		self.requester = data['requester']
 		self.printer = options['printer']
 
 
+	def _is_known(self, response):
+		if response.md5_404 in self.error_pages:
+			return True
+
+		if self.distance is None or response.simhash_404 is None:
+			return False
+
+		for simhash in self.error_simhashes:
+			if simhash_distance(simhash, response.simhash_404) <= self.distance:
+				return True
+
+		return False
+
+
 	def run(self):
 		self.printer.print('Error page detection...', 1)
 
 		urls = [ [{'host': self.host, 'url': u}] for u in self.urls ]
 
-		self.requester.set_fingerprints(urls)
-		self.requester.set_find_404(True)
+		stream = self.requester.stream(urls, self.stable_after)
+		unchanged = 0
+		for _, response in stream:
+			if response is None: continue
+
+			if self._is_known(response):
+				unchanged += 1
+			else:
+				unchanged = 0
+
+			self.responses.append(response)
+			self.error_pages.add(response.md5_404)
+			if self.distance is not None and response.simhash_404 is not None:
+				self.error_simhashes.append(response.simhash_404)
 
-		results = self.requester.run()
-		while results.qsize() > 0:
-			md5sum, url = results.get()
-			self.error_pages.add(md5sum)
-			self.printer.print('- Error page fingerprint: %s - %s' % (md5sum, url), 3)
+			self.printer.print('- Error page fingerprint: %s - %s' % (response.md5_404, response.url), 3)
 
-		self.requester.set_find_404(False)
+			if unchanged == self.stable_after:
+				break
+
+		stream.close()
 
 
 	def get_error_pages(self):
 		return self.error_pages
 
 
+	def get_error_simhashes(self):
+		return self.error_simhashes
+
+
+	def get_responses(self):
+		return self.responses
+
+
+
+class DiscoverPassive(object):
+	# find the CMSs that the responses seen before CMS detection point
+	# to, i.e. the response for the input URL and the error pages.
+	# The url-less string and regex fingerprints (e.g. generator meta 
+	# tags) and all header fingerprints (e.g. cookies) are checked. The 
+	# status code of the fingerprints is ignored, as the CMSs are only
+	# used to decide which URLs to request first. For the same reason,
+	# only the CMSs with URLs to request are returned, and not e.g. 
+	# JavaScript libraries or platforms
+
+	def __init__(self, options, data):
+		self.printer = options['printer']
+		self.matcher = data['matcher']
+
+		fingerprints = data['fingerprints']
+		self.cms = set(fingerprints.cms_index)
+		types = ['header', 'string', 'regex']
+		self.fps = [fp for fp in fingerprints.get_url_less() if fp['type'] in types]
+		self.fps += [fp for fp in fingerprints.get_fingerprints_by_type('header') if 'url' in fp]
+
+
+	def _get_matches(self, response):
+		content_type = response.headers.get('content-type', '')
+		is_image = content_type == '' or 'image' in content_type
+
+		for fp in self.fps:
+			if fp['type'] == 'header':
+				match = self.matcher.header(fp, response)
+			elif is_image:
+				continue
+			elif fp['type'] == 'string':
+				match = self.matcher.string(fp, response)
+			else:
+				match = self.matcher.regex(fp, response)
+
+			if match is not None:
+				yield match
+
+
+	def run(self, responses):
+		# returns the names of the CMSs found, in the order they are found
+		self.printer.print('Passive detection...', 1)
+
+		found = []
+		for response in responses:
+			if response is None: continue
+
+			for fp in self._get_matches(response):
+				name = fp['name'] if 'name' in fp else fp.get('cms', '')
+				if name in self.cms and not name in found:
+					self.printer.print('- %s: %s' % (name, response.url), 2)
+					found.append(name)
+
+		return found
+
+
+
 class DiscoverCMS(object):
 
 	def __init__(self, options, data):
-		self.chunk_size = options['chunk_size']
 		self.printer = options['printer']
 		self.matcher = data['matcher']
 		self.requester = data['requester']
-		self.fps = data['fingerprints'].get_ordered_list()
-		self.fps_iter = iter(self.fps)
-		self.index = 0
+		self.stream = None
+		self.done = False
+
+		# the scheduler picks the next URL based on the results so far
+		if options['probe_order'] == 'gain':
+			self.scheduler = ProbeScheduler(data['fingerprints'], self.matcher)
+			self.fps = self.scheduler
+		else:
+			self.scheduler = None
+			self.fps = data['fingerprints'].get_ordered_list()
 		
 
 	def is_done(self):
-		return self.index >= len(self.fps)
+		return self.done
 
 
-	def run(self):
-		i = self.index
-		cs = self.chunk_size
+	# request the URLs of these CMSs first. Must be called before 'run'
+	def prioritize(self, cms_list):
+		if self.scheduler is not None:
+			self.scheduler.prioritize(cms_list)
+		else:
+			first = [fps for fps in self.fps if any(fp['cms'] in cms_list for fp in fps)]
+			moved = {id(fps) for fps in first}
+			self.fps = first + [fps for fps in self.fps if not id(fps) in moved]
 
-		# extract a chunck
-		chunk = self.fps[i:i+cs]
-		self.index += cs
 
-		self.requester.set_fingerprints(chunk)
-		results = self.requester.run()
+	def run(self):
+		# the responses are matched as they arrive. The stream is kept
+		# open between calls, so the next call continues where the 
+		# previous one stopped
+		if self.stream is None:
+			self.stream = self.requester.stream(self.fps)
 
 		# process the results and find matches
-		while results.qsize() > 0:
-			fps,response = results.get()
-			matches = self.matcher.get_result(fps, response)
+		for fps,response in self.stream:
+			matches = [] if response is None else self.matcher.get_result(fps, response)
+			if self.scheduler is not None:
+				self.scheduler.update(fps, response, matches)
+
 			if matches:
 				return [cms['cms'] for cms in matches]
 
+		self.done = True
 		return []
 
 
+	# cancel the requests that are still outstanding
+	def stop(self):
+		if self.stream is not None:
+			self.stream.close()
+
+
 class DiscoverVersion(object):
 	def __init__(self, options, data):
-		self.chunk_size = options['chunk_size']
 		self.printer = options['printer']
 		self.result = data['results']
 		self.matcher = data['matcher']
 		self.requester = data['requester']
 		self.fingerprints = data['fingerprints']
+		self.mode = options['version_detection']
+		self.margin = options['confidence_margin']
+
+
+	def _get_plan(self, cms, fps):
+		# the fingerprints for the URLs in the probe plan, and for the
+		# URLs that do not only have md5 fingerprints, as these add to 
+		# the scores directly. None is returned if there is no plan
+		urls = self.fingerprints.get_probe_plan(cms)
+		if urls is None:
+			return None
+
+		by_url = {fp_list[0]['url']: fp_list for fp_list in fps}
+		plan = [url for url in by_url if not all(fp['type'] == 'md5' for fp in by_url[url])]
+		plan += [url for url in urls if url in by_url and not url in plan]
+
+		return [by_url[url] for url in plan]
 
 
 	def run(self, cms):
 		self.printer.print('Version detection...', 1)
-		cs = self.chunk_size
 		fps = self.fingerprints.get_fingerprints_for_cms(cms)
+		scheduler = None
+
+		# request all the URLs in the probe plan at once. If there is 
+		# no plan for the cms, the URLs are chosen adaptively
+		plan = self._get_plan(cms, fps) if self.mode == 'plan' else None
+		if plan is not None:
+			fps = plan
 
-		for i in range(0, len(fps), cs):
-			chunk = fps[i:i+cs]
+		# only request the URLs needed to tell the versions apart
+		elif not self.mode == 'exhaustive':
+			scheduler = VersionScheduler(fps)
+			fps = scheduler
 
-			self.requester.set_fingerprints(chunk)
-			results = self.requester.run()
+		stream = self.requester.stream(fps)
+		for res_fps,response in stream:
+			matches = [] if response is None else self.matcher.get_result(res_fps, response)
+			if scheduler is not None:
+				scheduler.update(res_fps, response, matches)
 
-			while results.qsize() > 0:
-				res_fps,response = results.get()
-				for fp in self.matcher.get_result(res_fps, response):
-					self.result.add_cms(fp)
+			for fp in matches:
+				self.result.add_cms(fp)
+
+			# stop when the best version is far enough ahead of the others
+			if not self.mode == 'exhaustive' and matches and self.result.confidence(cms) >= self.margin:
+				break
+
+		stream.close()
 
 
 class DiscoverOS(object):
@@ -205,6 +374,7 @@ class DiscoverOS(object):
 
 
 	def finalize(self):
+		self.printer.print('OS detection...', 1)
 		
 		platforms = self.results.get_platform_results()
 		for pkg in platforms:
@@ -253,22 +423,16 @@ class DiscoverOS(object):
 				break
 
 
-	def run(self):
-		self.printer.print('OS detection...', 1)
-		headers = set()
-		responses = self.cache.get_responses()
-		for response in responses:
-			self.find_match(response)
-
-		self.finalize()
+	def visit(self, response):
+		self.find_match(response)
 
 
 
 # Used by the DiscoverMore crawler
 # The
 class LinkExtractor(HTMLParser):
-	def __init__(self, strict):
-		super().__init__(strict=strict)
+	def __init__(self):
+		super().__init__()
 		self.results = set()
 
 	def get_results(self):
@@ -292,13 +456,14 @@ class DiscoverMore(object):
 
 	def __init__(self, options, data):
 		self.host = options['host']
-		self.threads = options['threads']
 		self.printer = options['printer']
 		self.cache = data['cache']
 		self.result = data['results']
 		self.matcher = data['matcher']
 		self.requester = data['requester']
 		self.fingerprints = data['fingerprints']
+		self.parser = LinkExtractor()
+		self.resources = set()
 
 
 	def _get_urls(self, response):
@@ -315,52 +480,50 @@ class DiscoverMore(object):
 		return urls
 
 	
-	def run(self):
-		self.printer.print('Link extraction...', 1, '')
-		resources = set()
-		parser = LinkExtractor(strict=False)
+	def visit(self, response):
+		# skip pages that do not set 'content-type'
+		# these might be binaries
+		if not 'content-type' in response.headers:
+			return
 
-		for req in self.cache.get_responses():
-			# skip pages that do not set 'content-type'
-			# these might be binaries
-			if not 'content-type' in req.headers:
-				continue
+		# only scrape pages that can contain links/references
+		if 'text/html' in response.headers['content-type']:
+			tmp = self._get_urls(response)
 
-			# only scrape pages that can contain links/references
-			if 'text/html' in req.headers['content-type']:
-				tmp = self._get_urls(req)
+			self.parser.feed(response.body)
+			tmp = tmp.union( self.parser.get_results())
 
-				parser.feed(req.body)
-				tmp = tmp.union( parser.get_results())
+			for i in tmp:
+				
+				# ensure that only resources located on the domain /sub-domain is requested 
+				if i.startswith('http') or i.startswith('//'):
+					parts = i.split('/')
+					host = parts[2]
 
-				for i in tmp:
-					
-					# ensure that only resources located on the domain /sub-domain is requested 
-					if i.startswith('http') or i.startswith('//'):
-						parts = i.split('/')
-						host = parts[2]
+					# if the resource is out side of the domain, skip it
+					if not host in self.host.split('/')[2]:
+						continue
 
-						# if the resource is out side of the domain, skip it
-						if not host in self.host.split('/')[2]:
-							continue
+					# else update the url so that it only contains the relative location
+					else:
+						i = '/'.join(parts[3:])
 
-						# else update the url so that it only contains the relative location
-						else:
-							i = '/'.join(parts[3:])
+				self.resources.add( i )
 
-					resources.add( i )
+
+	def finalize(self):
+		self.printer.print('Link extraction...', 1, '')
 
 		# the items in the resource set should mimic a list of fingerprints:
 		# a fingerprint is a dict with at least an URL key
-		urls = [ [{'url':i}] for i in resources ]
+		urls = [ [{'url':i}] for i in self.resources ]
 		self.printer.print(' Discovered %s new resources' % (len(urls), ), 2, '')
 
 		# fetch the discovered resources.
 		# As this class' purpose only is to fetch the resource (add to cache)
 		# there is no return value, or further actions needed
-		for i in range(0, len(urls), self.threads):
-			self.requester.set_fingerprints( urls[i:i+self.threads] )
-			results = self.requester.run()
+		for _ in self.requester.stream(urls, self.requester.max_window):
+			pass
 
 		self.printer.print('', 1)
 
@@ -377,12 +540,14 @@ class DiscoverAllCMS(object):
 		self.matcher = data['matcher']
 
 
-	def run(self):
-		# find matches for all the responses in the cache
-		for response in self.cache.get_responses():
-			matches = self.matcher.get_result(self.fps, response)
-			for fp in matches:
-				self.results.add_cms(fp)
+	def visit(self, response):
+		# find matches for the response
+		matches = self.matcher.get_result(self.fps, response)
+		for fp in matches:
+			self.results.add_cms(fp)
+
+	def finalize(self):
+		pass
 	
 
 class DiscoverJavaScript(object):
@@ -393,21 +558,21 @@ class DiscoverJavaScript(object):
 		self.matcher = data['matcher']
 		self.result = data['results']
 
-	def run(self):
+	def visit(self, response):
+		# match only if the response is JavaScript
+		#  check content type
+		content_type = response.headers['content-type'] if 'content-type' in response.headers else ''
+		# and extension
+		is_js = 'javascript' in content_type or '.js' in response.url.split('.')[-1]
+
+		# if the response is JavaScript try to match it to the known fingerprints 
+		if is_js:
+			matches = self.matcher.get_result(self.fingerprints, response)
+			for fp in matches:
+				self.result.add( fp['category'], fp['name'], fp['output'], fingerprint=fp, weight=1)
+
+	def finalize(self):
 		self.printer.print('Javascript detection...', 1)
-		for response in self.cache.get_responses():
-			
-			# match only if the response is JavaScript
-			#  check content type
-			content_type = response.headers['content-type'] if 'content-type' in response.headers else ''
-			# and extension
-			is_js = 'javascript' in content_type or '.js' in response.url.split('.')[-1]
-
-			# if the response is JavaScript try to match it to the known fingerprints 
-			if is_js:
-				matches = self.matcher.get_result(self.fingerprints, response)
-				for fp in matches:
-					self.result.add( fp['category'], fp['name'], fp['output'], fingerprint=fp, weight=1)
 
 
 class DiscoverInteresting(object):
@@ -417,29 +582,23 @@ class DiscoverInteresting(object):
 		self.interesting = data['fingerprints'].get_interesting_fingerprints()
 		self.matcher = data['matcher']
 		self.result = data['results']
-		self.threads = options['threads']
 		self.category = "Interesting"
 
 	def run(self):
 		self.printer.print('Detecting interesting files...', 1)
 
-		cs = self.threads
-
-		for i in range(0, len(self.interesting), cs):
-			chunk = self.interesting[i:i+cs]
-
-			self.requester.set_fingerprints(chunk)
-			results = self.requester.run()
-			while results.qsize() > 0:
-				fps,response = results.get()
+		# every file is requested, so as many requests as possible are
+		# kept in flight
+		for fps,response in self.requester.stream(self.interesting, self.requester.max_window):
+			if response is None: continue
 
-				matches = self.matcher.get_result(fps, response)
-		
-				# their should not have been a redirection 
-				# when requesting these files
-				if len(response.history) == 0:
-					for fp in matches:
-						self.result.add( self.category, None, None, fp, weight=1)
+			matches = self.matcher.get_result(fps, response)
+	
+			# their should not have been a redirection 
+			# when requesting these files
+			if len(response.history) == 0:
+				for fp in matches:
+					self.result.add( self.category, None, None, fp, weight=1)
 
 
 class DiscoverUrlLess(object):
@@ -450,15 +609,15 @@ class DiscoverUrlLess(object):
 		self.results = data['results']
 		self.matcher = data['matcher']
 
-	def run(self):
-		self.printer.print('Matching urlless fingerprints...', 1)
-		
-		# find matches for all the responses in the cache
-		for response in self.cache.get_responses():
-			matches = self.matcher.get_result(self.fps, response)
-			for fp in matches:
-				if 'name' in fp:	name = fp['name']
-				elif 'cms' in fp:	name = fp['cms']
-				else:				name = ''
+	def visit(self, response):
+		# find matches for the response
+		matches = self.matcher.get_result(self.fps, response)
+		for fp in matches:
+			if 'name' in fp:	name = fp['name']
+			elif 'cms' in fp:	name = fp['cms']
+			else:				name = ''
+
+			self.results.add(fp['category'], name, fp['output'], fingerprint=fp, weight=1)
 
-				self.results.add(fp['category'], name, fp['output'], fingerprint=fp, weight=1)
\ No newline at end of file
+	def finalize(self):
+		self.printer.print('Matching urlless fingerprints...', 1)
@@ -1,10 +1,10 @@
-import json,os, sys, pprint
+import json,os, sys, pprint, pickle
 from collections import defaultdict
 
 
 class Fingerprints(object):
 
-	def __init__(self):
+	def __init__(self, snapshot='data/fingerprints.snapshot'):
 		
 		# Dictionaries in python3.3 use a random hashing algorithm,
 		# which means that the order items in i dict is not consistent
@@ -25,19 +25,105 @@ class Fingerprints(object):
 		self.js_fingerprints = []	# javascript fingerprints
 		self.url_less = []			# fingerprints that don't have an url specified
 		self.translator = {}		# dict containing file name mappings
+		self.probe_plan = {}		# cms -> probe plan. See 'classes/probeplan.py'
+
+		# indexes over the fingerprints. See '_create_indexes'
+		self.url_index = {}			# url -> list of fingerprints
+		self.cms_index = {}			# cms -> url -> list of fingerprints
+		self.type_index = {}		# type -> list of fingerprints
+
+		# parsing the json files is by far the most expensive part of
+		# starting wig, so the loaded fingerprints are stored in a
+		# precompiled snapshot. The snapshot is only used if none of
+		# the source files have changed since it was written
+		if not self._load_snapshot(snapshot):
+
+			# load fingerprints
+			self._load_dictionary()
+			self._load()
+			self._load_os()
+			self._load_js()	
+			self._load_interesting()
+			self._load_error()
+			self._load_probe_plan()
+			
+			self._create_indexes()
+			self.create_ordered_list()
+
+			self.save_snapshot(snapshot)
+
+
+	def _get_signature(self):
+		# the signature of the fingerprint database is the name, size
+		# and modification time of every json file in 'data/'.
+		# This module is included as well, since changes to the loading
+		# code also changes the contents of the snapshot
+		files = [__file__]
+		for path, _, file_names in os.walk('data'):
+			files.extend(os.path.join(path, f) for f in file_names if f.endswith('.json'))
+
+		signature = []
+		for f in sorted(files):
+			stat = os.stat(f)
+			signature.append( (os.path.relpath(f), stat.st_size, stat.st_mtime_ns) )
+
+		return signature
+
+
+	def _load_snapshot(self, snapshot):
+		# returns True if the fingerprints were loaded from the snapshot
+		if snapshot is None or not os.path.exists(snapshot):
+			return False
+
+		try:
+			with open(snapshot, 'rb') as fh:
+				# the signature is stored as a separate pickle in front of
+				# the fingerprints, so an outdated snapshot can be discarded
+				# without unpickling all of it
+				if not pickle.load(fh) == self._get_signature():
+					return False
+
+				state = pickle.load(fh)
+		except Exception as e:
+			return False
+
+		# the os fingerprints are stored as a plain dict, since
+		# defaultdicts using lambdas cannot be pickled
+		os_fingerprints = state.pop('os_fingerprints')
+		for sw in os_fingerprints:
+			self.os_fingerprints[sw].update(os_fingerprints[sw])
+
+		self.__dict__.update(state)
+
+		return True
+
+
+	def save_snapshot(self, snapshot):
+		# write the loaded fingerprints to the snapshot. 
+		# This is the compile step, which is run automatically when the
+		# snapshot is missing or outdated
+		if snapshot is None: return
+
+		state = dict(self.__dict__)
+		state['os_fingerprints'] = {sw: dict(self.os_fingerprints[sw]) for sw in self.os_fingerprints}
+
+		# several instances of wig might be started at the same time, so
+		# the snapshot is written to a temporary file which is then moved
+		# into place
+		tmp_name = '%s.%s' % (snapshot, os.getpid())
+		try:
+			with open(tmp_name, 'wb') as fh:
+				pickle.dump(self._get_signature(), fh, pickle.HIGHEST_PROTOCOL)
+				pickle.dump(state, fh, pickle.HIGHEST_PROTOCOL)
+
+			os.replace(tmp_name, snapshot)
+
+		# failing to write the snapshot is not fatal
+		except Exception as e:
+			if os.path.exists(tmp_name):
+				os.remove(tmp_name)
 
 
-		# load fingerprints
-		self._load_dictionary()
-		self._load()
-		self._load_os()
-		self._load_js()	
-		self._load_interesting()
-		self._load_error()
-		
-		self.create_ordered_list()
-		
-
 	def _load_dictionary(self):
 		path = 'data/dictionary.json'
 		with open(path) as fh:
@@ -50,6 +136,14 @@ class Fingerprints(object):
 			self.error_pages = json.load(fh)
 
 
+	def _load_probe_plan(self):
+		# the probe plan is optional
+		path = 'data/probe_plan.json'
+		if os.path.exists(path):
+			with open(path) as fh:
+				self.probe_plan = json.load(fh)
+
+
 	def _load_interesting(self):
 		path = 'data/interesting.json'
 		category = 'Interesting'
@@ -168,53 +262,41 @@ class Fingerprints(object):
 					continue
 
 
+	def _create_indexes(self):
+		# build the indexes once, such that lookups of fingerprints by
+		# url, cms or type do not require a scan of all the fingerprints.
+		# The dicts keep the order in which the fingerprints were loaded
+		for fp in self.all:
+			self.url_index.setdefault(fp['url'], []).append(fp)
+			self.cms_index.setdefault(fp['cms'], {}).setdefault(fp['url'], []).append(fp)
+
+		for fp in self.all + self.url_less:
+			self.type_index.setdefault(fp['type'], []).append(fp)
+
+
 	def create_ordered_list(self):
-		
-		# list of fp with unique urls
-		seen_urls = set()
-		fp_unique_urls = []
-		for fp in self.all: 
-			if fp['url'] not in seen_urls:
-				fp_unique_urls.append(fp)
-				seen_urls.add(fp['url'])
-
-		# count the max number of urls for the cms
-		count = defaultdict(set)
-		for fp in fp_unique_urls: 
-			count[fp['cms']].add( fp['url'] )
-
-		max_number_urls = max( [len(count[i]) for i in count] )
-
-		# create a matrix of names vs fps
+
+		# create a matrix of names vs urls. Each url is placed in the
+		# row of the cms of the first fingerprint using the url
 		# [
-		#   [fp1, fp2, fp3],        <--- cms 1
-		#   [fp4, fp5],             <--- cms 2
-		#   [fp6, fp7, fp8, fp8]    <--- cms 3
+		#   [url1, url2, url3],        <--- cms 1
+		#   [url4, url5],              <--- cms 2
+		#   [url6, url7, url8, url9]   <--- cms 3
 		# ]
-		matrix = [[] for _ in self._cms_names]
-		for fp in fp_unique_urls:
-			name_index = self._cms_names.index(fp['cms'])
-			matrix[name_index].append(fp)
+		matrix = defaultdict(list)
+		for url in self.url_index:
+			matrix[self.url_index[url][0]['cms']].append(url)
 
+		max_number_urls = max( [len(matrix[i]) for i in matrix] )
 
-		# flatten the matrix to a single list
+		# flatten the matrix to a single list, taking one url from
+		# each cms at a time. Every item in the list contains all
+		# the fingerprints for the url
 		for fp_index in range(0, max_number_urls):
 			for cms in self._cms_names:
-				try:
-					index = self._cms_names.index(cms)
-					fp = matrix[index][fp_index]
-					self.ordered.append(fp)
-				except:
-					pass
-
-		# collect all urls for each fp
-		# crappy O(n^2) implementation - should be redone at some point
-		out = []
-		for fp in self.ordered:
-			url = fp['url']
-			out.append( [fp for fp in self.all if fp['url'] == url] )
-
-		self.ordered = out
+				urls = matrix[cms]
+				if fp_index < len(urls):
+					self.ordered.append(self.url_index[urls[fp_index]])
 
 
 	# this returns the raw list of fingerprints
@@ -254,12 +336,36 @@ class Fingerprints(object):
 	# used for version detection of a single
 	# cms - DiscoverVersion()
 	def get_fingerprints_for_cms(self, cms):
-		fps = defaultdict(list)
-		for fp in self.all:
-			if fp['cms'] == cms:
-				fps[fp['url']].append(fp)
+		if not cms in self.cms_index:
+			return []
+
+		return list(self.cms_index[cms].values())
+
+
+	# get the URLs of the probe plan for a specific cms, ranked by how
+	# many versions they tell apart. None is returned if there is no plan,
+	# or if versions have been added since the plan was compiled
+	def get_probe_plan(self, cms):
+		if not cms in self.probe_plan:
+			return None
 
-		return [ fps[i] for i in fps ]
+		plan = self.probe_plan[cms]
+		versions = {fp['output'] for fps in self.get_fingerprints_for_cms(cms) for fp in fps if fp['type'] == 'md5'}
+		if not versions <= set(plan['versions']):
+			return None
+
+		return plan['urls']
+
+
+	# get all the fingerprints at a specific url
+	def get_fingerprints_for_url(self, url):
+		return self.url_index.get(url, [])
+
+
+	# get fingerprints of a specific type, i.e. 'md5', 'string',
+	# 'regex' or 'header'
+	def get_fingerprints_by_type(self, fp_type):
+		return self.type_index.get(fp_type, [])
 
 
 	# fingerprints used for JavaScript detection
@@ -272,3 +378,8 @@ class Fingerprints(object):
 		return self.interesting
 
 
+
+# compile the fingerprint snapshot:
+# $ python3 -m classes.fingerprints
+if __name__ == '__main__':
+	Fingerprints(snapshot=None).save_snapshot('data/fingerprints.snapshot')
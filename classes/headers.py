@@ -6,6 +6,7 @@ class ExtractHeaders(object):
 		self.results = data['results']
 		self.log = log
 		self.headers = set()
+		self.seen = set()
 		self.category = "Platform"
 
 	def _split_server_line(self, line):
@@ -19,19 +20,17 @@ class ExtractHeaders(object):
 	def add_header(self, response):
 		for header in response.headers:
 
-			# extract the headers and values. 
-			headers = [(hdr, value) for hdr, value, url in self.headers]
-
 			# if the header and value is not in the header set, add them along with the url.
 			# only the first header,value,url set should be added. 
-			if not (header, response.headers[header]) in headers:
+			if not (header, response.headers[header]) in self.seen:
+				self.seen.add( (header, response.headers[header]) )
 				self.headers.add( (header, response.headers[header], response.url))
 
-	def run(self):
-		# get all the headers seen during the scan
-		for response in self.cache.get_responses():
-			self.add_header(response)
+	# get all the headers seen during the scan
+	def visit(self, response):
+		self.add_header(response)
 
+	def finalize(self):
 		# examine all the headers found
 		for hdr,val,url in self.headers:
 			
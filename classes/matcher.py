@@ -1,13 +1,195 @@
 import re
+from collections import defaultdict
+from classes.request import simhash_distance
+
+
+# compiled regexes, shared by all the Match instances
+_compiled_regexes = {}
+
+def compile_regex(regex):
+	if not regex in _compiled_regexes:
+		_compiled_regexes[regex] = re.compile(regex)
+
+	return _compiled_regexes[regex]
+
+
+def get_required_literal(regex):
+	# find a string of literal characters that is present in any text 
+	# that the regex matches. This is the longest run of literal 
+	# characters outside of groups, classes and repetitions.
+	# An empty string is returned if no such string is found
+	if compile_regex(regex).flags & (re.IGNORECASE | re.VERBOSE):
+		return ''
+
+	runs = []
+	current = ''
+	depth = 0
+	i = 0
+	while i < len(regex):
+		char = regex[i]
+
+		# escaped punctuation is a literal, while escapes such as \d 
+		# or \1 are not
+		if char == '\\':
+			escaped = regex[i+1:i+2]
+			if depth == 0 and escaped and not escaped.isalnum():
+				current += escaped
+			else:
+				runs.append(current)
+				current = ''
+			i += 2
+			continue
+
+		# skip character classes
+		elif char == '[':
+			i += 1
+			if regex[i:i+1] == '^': i += 1
+			if regex[i:i+1] == ']': i += 1
+			while i < len(regex) and not regex[i] == ']':
+				i += 2 if regex[i] == '\\' else 1
+
+			runs.append(current)
+			current = ''
+
+		# the text matched by the regex could be from any of the 
+		# alternatives, so nothing is required
+		elif char == '|' and depth == 0:
+			return ''
+
+		# the preceding character is optional
+		elif char in '*?' or re.match(r'\{\d*,?\d*\}', regex[i:]):
+			runs.append(current[:-1])
+			current = ''
+			if char == '{':
+				i = regex.index('}', i)
+
+		# the preceding character is required, but might be repeated
+		elif char == '+':
+			runs.append(current)
+			current = ''
+
+		elif char in '().^${|' or depth > 0:
+			runs.append(current)
+			current = ''
+			if char == '(': depth += 1
+			if char == ')': depth -= 1
+
+		else:
+			current += char
+
+		i += 1
+
+	runs.append(current)
+	return max(runs, key=len)
+
+
+def can_combine_regex(regex):
+	# regexes can be combined into a single alternation, unless they
+	# refer to groups by number or name, or set flags
+	return re.search(r'\\\d|\(\?P[=<]|\(\?[aiLmsux]', regex) is None
+
+
+class FingerprintIndex(object):
+	# An index over a list of fingerprints. Instead of testing every 
+	# fingerprint against a response, the index is used to find the 
+	# fingerprints that can match the response. The candidates are 
+	# returned in the same order as in the original list, and are still
+	# checked by the Match instance, so the results are unchanged.
+
+	# each distinct string is searched for once per response. A single 
+	# scan for all the strings, with an automaton in python or with an
+	# alternation of the strings, is slower than the substring search in
+	# C for the number of strings in the database (about a hundred)
+
+	def __init__(self, fingerprints):
+		self.md5 = defaultdict(list)		# md5 -> [(position, fp), ...]
+		self.needles = defaultdict(list)	# string -> [(position, fp), ...]
+		self.headers = defaultdict(list)	# header -> [(position, fp), ...]
+		self.combined = []					# [(position, fp), ...]
+		self.other = []						# fingerprints that are not indexed
+
+		for position, fp in enumerate(fingerprints):
+			if fp['type'] == 'md5':
+				self.md5[fp['md5']].append((position, fp))
+
+			# 'string' fingerprints are found by their string, and 'regex' 
+			# fingerprints by a string the regex requires. 
+			elif fp['type'] == 'string':
+				self.needles[fp['string']].append((position, fp))
+
+			elif fp['type'] == 'regex' and get_required_literal(fp['regex']):
+				self.needles[get_required_literal(fp['regex'])].append((position, fp))
+
+			# regexes without a literal are checked with a single regex
+			# combining all of them. They can only match if it matches
+			elif fp['type'] == 'regex' and can_combine_regex(fp['regex']):
+				self.combined.append((position, fp))
+
+			elif fp['type'] == 'header':
+				self.headers[fp['header'].lower()].append((position, fp))
+
+			else:
+				self.other.append((position, fp))
+
+		if self.combined:
+			regexes = ['(?:%s)' % (fp['regex'], ) for _, fp in self.combined]
+			self.combined_regex = re.compile('|'.join(regexes))
+		else:
+			self.combined_regex = None
+
+
+	def _find_needles(self, body):
+		# find the strings of the indexed fingerprints that are in the body
+		return [string for string in self.needles if string in body]
+
+
+	def get_candidates(self, response, is_image):
+		candidates = self.md5.get(response.md5, []) + self.other
+
+		for header in response.headers:
+			if header in self.headers:
+				candidates += self.headers[header]
+
+		# string and regex fingerprints are not matched against images
+		if not is_image:
+			for string in self._find_needles(response.body):
+				candidates += self.needles[string]
+
+			if self.combined_regex is not None and self.combined_regex.search(response.body):
+				candidates += self.combined
+
+		return [fp for _, fp in sorted(candidates, key=lambda x: x[0])]
+
+
 
 class Match(object):
 	def __init__(self):
 		self.error_pages = set()	
-	
+		self.error_simhashes = []
+		self.distance = None
+
+		# lists of fingerprints with at least this many items are
+		# matched using an index. See '_get_index'
+		self.index_threshold = 8
+		self.indexes = {}
+
+
+	def _get_index(self, fingerprints):
+		# the index is created the first time a list of fingerprints is 
+		# matched, and reused afterwards. The lists are identified by 
+		# their id, so a reference to the list is kept along with the
+		# index to ensure that the id is not reused by another list
+		key = id(fingerprints)
+		if not key in self.indexes:
+			self.indexes[key] = (fingerprints, FingerprintIndex(fingerprints))
+
+		return self.indexes[key][1]
+
+
 	def _check_page(self, response, fingerprint):
 
 		# check if the page is a 404
-		is_404 = response.status['code'] == 404 or response.md5_404 in self.error_pages
+		is_404 = self.is_404(response)
 
 		# fingerprints that do not have a 'code' set, default to 200
 		# find the 'code' of the current fingerprint
@@ -29,8 +211,40 @@ class Match(object):
 			return True
 
 
-	def set_404s(self, set_of_404s):
+	def is_404(self, response):
+		return response.status['code'] == 404 or self._is_error_page(response)
+
+
+	def _is_error_page(self, response):
+		# the md5 and simhash of the cleaned page are only calculated 
+		# if there are error pages to compare them to
+		if len(self.error_pages) == 0:
+			return False
+
+		if response.md5_404 in self.error_pages:
+			return True
+
+		if self.distance is None or len(self.error_simhashes) == 0:
+			return False
+
+		simhash = response.simhash_404
+		if simhash is None:
+			return False
+
+		for error_simhash in self.error_simhashes:
+			if simhash_distance(simhash, error_simhash) <= self.distance:
+				return True
+
+		return False
+
+
+	def set_404s(self, set_of_404s, simhashes=(), distance=None):
+		# if 'distance' is set, pages are also error pages if their 
+		# simhash differs from that of an error page in at most 
+		# 'distance' bits
 		self.error_pages = set_of_404s
+		self.error_simhashes = simhashes
+		self.distance = distance
 
 
 	def get_result(self, fingerprints, response):
@@ -49,6 +263,10 @@ class Match(object):
 		else:
 			is_image = True
 
+		# use an index to skip fingerprints that cannot match
+		if len(fingerprints) >= self.index_threshold:
+			fingerprints = self._get_index(fingerprints).get_candidates(response, is_image)
+
 		for fingerprint in fingerprints:
 
 			# only check the page if the status codes match
@@ -75,7 +293,7 @@ class Match(object):
 
 		return matches
 
-	
+
 	def md5(self, fingerprint, response):
 		if fingerprint["md5"] == response.md5:
 			return fingerprint
@@ -84,51 +302,55 @@ class Match(object):
 
 	
 	def string(self, fingerprint, response):
-		if fingerprint["string"] in response.body:
-			return fingerprint
-		else:
-			return None
+		return self._match_string(fingerprint, response.body)
 
 	
 	def regex(self, fingerprint, response):
-		# create copy of fingerprint
-		copy = {key:fingerprint[key] for key in fingerprint}
-
-		regex = copy["regex"]
-		output = copy["output"]
-
-		matches = re.findall(regex, response.body)
-		if len(matches):
-			if "%" in output:
-				copy['output'] = output % matches[0]
-			
-			return copy
-		else:
-			return None
+		return self._match_regex(fingerprint, response.body)
 
 	
 	def header(self, fingerprint, response):
-		fp_header = fingerprint['header']
-		match_type = 'string' if 'string' in fingerprint else 'regex'
+		fp_header = fingerprint['header'].lower()
 
-		# a dummy class to mimic a response
-		class response_dummy(object):
-			self.body = ''
+		# bail if the response does not have the header
+		if not fp_header in response.headers:
+			return None
 
-		# parse the headers searching for a match
-		for header in response.headers:
-			if header == fp_header.lower():
+		if 'string' in fingerprint:
+			return self._match_string(fingerprint, response.headers[fp_header])
+		else:
+			return self._match_regex(fingerprint, response.headers[fp_header])
 
-				# create an intance of the dummy class
-				r = response_dummy()
-				r.body = response.headers[header]
 
-				# call the Match instances methods for string or regex matching
-				if 'string' in fingerprint:
-					return self.string(fingerprint, r)
-				else:
-					return self.regex(fingerprint, r)
+	def _match_string(self, fingerprint, text):
+		if fingerprint["string"] in text:
+			return fingerprint
+		else:
+			return None
+
 
+	def _match_regex(self, fingerprint, text):
+		match = compile_regex(fingerprint["regex"]).search(text)
+		if match is None:
+			return None
 
+		output = fingerprint["output"]
+
+		# only create a copy of the fingerprint if the output 
+		# should be updated with the matched values.
+		# The value used is the same as the first item returned 
+		# by re.findall 
+		if "%" in output:
+			groups = match.groups(default='')
+			if len(groups) == 0:
+				value = match.group(0)
+			elif len(groups) == 1:
+				value = groups[0]
+			else:
+				value = groups
 
+			copy = {key:fingerprint[key] for key in fingerprint}
+			copy['output'] = output % value
+			return copy
 
+		return fingerprint
@@ -0,0 +1,49 @@
+
+# wig - PostProcessor
+#
+# The post-processing stages (header extraction, JavaScript detection,
+# OS detection, etc.) all examine the responses in the cache. Instead of
+# each stage walking the cache, the stages are registered as visitors,
+# and every unique response is visited once.
+#
+# A visitor implements:
+#   visit(response): called once for every response
+#   finalize():      called after the visitor has seen all the responses
+#
+# The visitors are finalized in the order they were added. Finalizing a
+# visitor might add responses to the cache (the crawler), which are
+# visited by the remaining visitors before these are finalized.
+
+
+class PostProcessor(object):
+
+	def __init__(self, data):
+		self.cache = data['cache']
+		self.visitors = []
+		self.visited = set()
+
+
+	def add_visitor(self, visitor):
+		self.visitors.append(visitor)
+
+
+	def _get_new_responses(self):
+		# the responses in the cache that have not been visited yet
+		responses = []
+		for response in self.cache.get_responses():
+			if not response.id in self.visited:
+				self.visited.add(response.id)
+				responses.append(response)
+
+		return responses
+
+
+	def run(self):
+		pending = list(self.visitors)
+
+		while pending:
+			for response in self._get_new_responses():
+				for visitor in pending:
+					visitor.visit(response)
+
+			pending.pop(0).finalize()
@@ -0,0 +1,152 @@
+import json, re
+from collections import defaultdict
+from classes.fingerprints import Fingerprints
+
+# wig - ProbePlan
+#
+# Computes a probe plan: for every CMS, a short ranked list of URLs that
+# together tell all of its known versions apart. DiscoverVersion can
+# request only these URLs (see '--version_detection plan').
+#
+# When the site runs version 'v', a response at a URL only rules out the
+# versions that do not have the md5 (or strings) of 'v' at that URL, and
+# only if 'v' has the file. The URLs are picked greedily: the next URL is the
+# one that rules out the most (version, version) pairs that are not
+# ruled out by the URLs picked so far. This is the greedy approximation
+# of the set cover over the version x URL matrix.
+#
+# Versions that cannot be told apart by any URL are reported, as these
+# show where the database is weak.
+#
+# compile the probe plan:
+# $ python3 -m classes.probeplan
+
+
+def count_bits(n):
+	return bin(n).count('1')
+
+
+def version_key(version):
+	# sort '2.0.9' before '2.0.10'. Versions with the same key, e.g. 
+	# 'mt5.02' and 'mt5.2', are sorted by the version itself
+	return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', version)]
+
+
+class ProbePlan(object):
+
+	def __init__(self, fingerprints):
+		self.fingerprints = fingerprints
+
+		# cms -> {'versions': [...], 'urls': [...], 'indistinguishable': [[...], ...]}
+		self.plan = {}
+
+
+	def _get_signatures(self, cms):
+		# returns url -> {version: signature}, where the signature is
+		# what is found at the url if the site runs the version: the md5
+		# of the file, and the strings that belong to the version.
+		# Fingerprints without a version do not tell versions apart
+		signatures = defaultdict(lambda: defaultdict(set))
+		for fps in self.fingerprints.get_fingerprints_for_cms(cms):
+			for fp in fps:
+				version = fp['output']
+				if fp['type'] == 'md5':
+					signatures[fp['url']][version].add(fp['md5'])
+				elif fp['type'] == 'string' and not version in ('', '%s'):
+					signatures[fp['url']][version].add(fp['string'])
+
+		return signatures
+
+
+	def _create_cms_plan(self, cms):
+		signatures = self._get_signatures(cms)
+		versions = sorted({v for url in signatures for v in signatures[url]}, key=lambda v: (version_key(v), v))
+		bits = {v: 1 << i for i, v in enumerate(versions)}
+
+		# url -> [(version, versions that are not ruled out), ...]
+		# A version might have several md5s at a URL, of which the site
+		# only serves one, so only the versions that share none of them
+		# are ruled out. The sets of versions are stored as bitmasks
+		same = {}
+		for url in signatures:
+			holders = defaultdict(int)
+			for version, signature in signatures[url].items():
+				for item in signature:
+					holders[item] |= bits[version]
+
+			same[url] = []
+			for version, signature in signatures[url].items():
+				mask = 0
+				for item in signature:
+					mask |= holders[item]
+				same[url].append((version, mask))
+
+		# version -> the versions that have not been ruled out yet if
+		# the site runs the version
+		remaining = {v: (1 << len(versions)) - 1 for v in versions}
+
+		urls = []
+		while True:
+			best, best_gain = None, 0
+			for url in same:
+				gain = sum(count_bits(remaining[v] & ~mask) for v, mask in same[url])
+				if gain > best_gain:
+					best, best_gain = url, gain
+
+			if best is None:
+				break
+
+			urls.append(best)
+			for v, mask in same.pop(best):
+				remaining[v] &= mask
+
+		# the version is only added to the results if something matches,
+		# so every version must have a file at one of the URLs
+		missing = set(versions) - {v for url in urls for v in signatures[url]}
+		while missing:
+			best = max(same, key=lambda url: len(missing & set(signatures[url])), default=None)
+			if best is None or not missing & set(signatures[best]):
+				break
+
+			urls.append(best)
+			missing -= set(signatures[best])
+			del same[best]
+
+		indistinguishable = set()
+		for v in versions:
+			if count_bits(remaining[v]) > 1:
+				indistinguishable.add(tuple(w for w in versions if remaining[v] & bits[w]))
+
+		return {
+			'versions': versions,
+			'urls': urls,
+			'indistinguishable': [list(group) for group in sorted(indistinguishable)]
+		}
+
+
+	def create(self):
+		for cms in sorted(self.fingerprints.cms_index):
+			self.plan[cms] = self._create_cms_plan(cms)
+
+
+	def report(self):
+		for cms in sorted(self.plan):
+			plan = self.plan[cms]
+			total = len(self.fingerprints.get_fingerprints_for_cms(cms))
+
+			print('%s: %s versions, %s of %s URLs' % (cms, len(plan['versions']), len(plan['urls']), total))
+			for group in plan['indistinguishable']:
+				print('  cannot be told apart: %s' % (', '.join(group), ))
+
+
+	def save(self, file_name):
+		with open(file_name, 'w') as fh:
+			json.dump(self.plan, fh, indent=1, sort_keys=True)
+
+
+
+if __name__ == '__main__':
+	plan = ProbePlan(Fingerprints(snapshot=None))
+	plan.create()
+	plan.report()
+	plan.save('data/probe_plan.json')
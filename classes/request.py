@@ -1,19 +1,156 @@
-import http.client, hashlib, re, string, random
+import http.client, hashlib, re, string, random, threading, time
+from collections import defaultdict
+
+# Removes the parts of an error page that might not be static. This is the
+# same method nmap's http.lua uses for error page detection
+# (nselib/http.lua: clean_404), which removes in this order:
+#  - times. Every run of two or more digits is removed, which also
+#    removes the digits of dates
+#  - AM and PM
+#  - dates with 4 and 2 digit years. As the digits are already removed,
+#    these only match digits that were joined by removing AM or PM
+#  - links and paths, from a '/' to the next space
+#  - windows paths, from a drive letter to the next space
+CLEAN_404_STEPS = [re.compile(pattern) for pattern in [
+	rb'(?:\d?\d:?){2,3}',
+	rb'[aA][mM]',
+	rb'[pP][mM]',
+	rb'\d{8}',
+	rb'\d{4}-\d{2}-\d{2}',
+	rb'\d{4}/\d{2}/\d{2}',
+	rb'\d{2}-\d{2}-\d{4}',
+	rb'\d{2}/\d{2}/\d{4}',
+	rb'\d{6}',
+	rb'\d{2}-\d{2}-\d{2}',
+	rb'\d{2}/\d{2}/\d{2}',
+	rb'/[^ ]+',
+	rb'[a-zA-Z]:\\[^ ]+',
+]]
+
+# None of the steps match a space, so every word (the text between two
+# spaces) is cleaned on its own. Most words are cleaned the same way by
+# a single scan for times, AM and PM, paths and windows paths. The scan
+# differs from the steps when a removal creates a new match, e.g. 'PAMM'
+# -> 'PM', or when a path would be left empty by the steps before it,
+# e.g. '/404', of which the '/' is kept. The words where this might 
+# happen are found by CLEAN_404_SPECIAL, and are cleaned step by step
+CLEAN_404 = re.compile(b'|'.join([
+	rb'(?:\d?\d:?){2,3}',
+	rb'[aApP][mM]',
+	rb'/[^ ]+',
+	rb'[a-zA-Z]:\\[^ ]+',
+]))
+
+# the characters that might be removed by the steps before the paths
+CLEAN_404_REMOVED = rb'[\d:aApPmM/-]'
+
+CLEAN_404_SPECIAL = re.compile(b'|'.join([
+	rb'\\',
+	rb'/' + CLEAN_404_REMOVED + rb'+(?![^ ])',
+	rb'[aApP](?:' + CLEAN_404_REMOVED + rb'+[mM]|[mM][\d/-])',
+	rb'[\d/-][aApP][mM]',
+]))
+
+
+def clean_404(page):
+	# return the page without the parts that might not be static
+	parts = []
+	start = 0
+	special = CLEAN_404_SPECIAL.search(page)
+	while special:
+		begin = page.rfind(b' ', start, special.start()) + 1 or start
+		end = page.find(b' ', special.end())
+		if end == -1: end = len(page)
+
+		word = page[begin:end]
+		for step in CLEAN_404_STEPS:
+			word = step.sub(b'', word)
+
+		parts.append(CLEAN_404.sub(b'', page[start:begin]))
+		parts.append(word)
+
+		start = end
+		special = CLEAN_404_SPECIAL.search(page, end)
+
+	parts.append(CLEAN_404.sub(b'', page[start:]))
+	return b''.join(parts)
+
+
+def clean_page_404(page):
+	# return the fingerprint of the stripped page 
+	return hashlib.md5(clean_404(page)).hexdigest().lower()
+
+
+# pages with fewer distinct words than this do not get a simhash, as the 
+# simhashes of short pages are too alike to tell them apart
+SIMHASH_MIN_WORDS = 8
+
+
+def simhash_page_404(page):
+	# Returns a 64 bit simhash of the stripped page, or None if the page is
+	# too short. Unlike the md5, the simhashes of two pages that only differ
+	# in a few places (e.g. a search box with the requested path, or a
+	# random token) only differ in a few bits.
+	# The features are the distinct words on the page
+	words = set(re.findall(rb'\w+', clean_404(page)))
+	if len(words) < SIMHASH_MIN_WORDS:
+		return None
+
+	features = [int.from_bytes(hashlib.md5(w).digest()[:8], 'big') for w in words]
+
+	# for every bit, count the number of features that has the bit set.
+	# the features are written as a string of bits, so the bits in each 
+	# position can be counted with slicing
+	bits = ''.join(format(f, '064b') for f in features)
+	simhash = 0
+	for i in range(64):
+		if bits[i::64].count('1')*2 > len(features):
+			simhash |= 1 << (63-i)
+
+	return simhash
+
+
+def simhash_distance(a, b):
+	# the number of bits that differ between two simhashes
+	return bin(a ^ b).count('1')
+
+
 
 class Request(object):
+	# The raw bytes of the body are kept, and the decoded body and the 
+	# md5 used for error page detection are only calculated when they 
+	# are used. Responses which are only matched by md5 (e.g. images) 
+	# never pay for either.
+	# The body can be handed over to a store (see cache.BodyStore), which
+	# keeps the raw and decoded body, and might move them out of memory
+
 	def __init__(self):
 		self.url = ''
 		self.protocol = ''
 		self.host = ''
 		self.status = {}
 		self.headers = {}
-		self.body = ''
 		self.history = []
 
+		self._content = b''
+		self.store = None
+		self.content_key = None
+
 		self.md5 = ''
-		self.md5_404 = ''
 		self.should_be_error_page = False
 
+		# set if only the first part of the body was kept
+		self.truncated = False
+
+		# set if the body was not kept at all. The md5 of the
+		# body is used for error page detection instead
+		self.dropped = False
+
+		self._body = None
+		self._md5_404 = None
+		self._simhash_404 = None
+		self._has_simhash_404 = False
+
 		chars=string.ascii_uppercase + string.digits
 		self.id = ''.join(random.choice(chars) for _ in range(16))
 
@@ -21,12 +158,99 @@ class Request(object):
 	def get_url(self):
 		return self.protocol + '://' + self.host + self.url
 
+
 	def set_body(self, body):
+		# set the raw body. It is decoded when first used
+		self.content = body
+		self._body = None
+		self._md5_404 = None
+		self._simhash_404 = None
+		self._has_simhash_404 = False
+
+
+	def set_store(self, store, key):
+		# let the store keep the body. It is stored under 'key'
+		self.store = store
+		self.content_key = key
+		self._content = None
+		self._body = None
+
+
+	@property
+	def content(self):
+		if self.store is not None:
+			return self.store.get(self.content_key)
+		return self._content
+
+
+	@content.setter
+	def content(self, content):
+		self.store = None
+		self.content_key = None
+		self._content = content
+
+
+	@property
+	def body(self):
+		if self.store is not None:
+			return self.store.get_decoded(self.content_key, self._get_encoding())
+
+		if self._body is None:
+			self._body = str(self._content, self._get_encoding(), errors='replace')
+		return self._body
+
+
+	@property
+	def md5_404(self):
+		if self._md5_404 is None:
+			if self.dropped:
+				self._md5_404 = self.md5
+			else:
+				self._md5_404 = clean_page_404(self.content)
+		return self._md5_404
+
+
+	@property
+	def simhash_404(self):
+		# None if the page is too short, or the body was dropped
+		if not self._has_simhash_404:
+			if not self.dropped:
+				self._simhash_404 = simhash_page_404(self.content)
+			self._has_simhash_404 = True
+		return self._simhash_404
+
+
+	def get_validators(self):
+		# returns the headers to send to check if the response has
+		# changed since it was fetched. The server responds with a 304
+		# if it has not
+		validators = {}
+		if 'etag' in self.headers:
+			validators['If-None-Match'] = self.headers['etag']
+		if 'last-modified' in self.headers:
+			validators['If-Modified-Since'] = self.headers['last-modified']
+
+		return validators
+
+
+	def __getstate__(self):
+		# the decoded body is not pickled, as it can be recreated
+		# from the raw body. The store is not pickled either, but the
+		# raw body is
+		state = self.__dict__.copy()
+		state['_body'] = None
+		state['_content'] = self.content
+		state['store'] = None
+		state['content_key'] = None
+		return state
+
+
+	def _get_encoding(self):
 		# check if the encoding is specified in the http header
 		content_type = 'Content-Type'.lower()
 
 		if not content_type in self.headers:
-			self.body = str(body, errors='replace')
+			return 'utf-8'
 
 		else:		
 			# find content-type definitions
@@ -41,12 +265,11 @@ class Request(object):
 
 			# set the encoding to use
 			if content_types['charset'] is not None:
-				self.body = str(body, content_types['charset'], errors='replace')
+				return content_types['charset']
 			elif content_types['text']:
-				self.body = str(body, 'ISO-8859-1', errors='replace')
+				return 'ISO-8859-1'
 			else:
-				self.body = str(body, errors='replace')
-		
+				return 'utf-8'
 
 
 	def __repr__(self):
@@ -66,9 +289,122 @@ class Request(object):
 		return string + get_string(self)
 		
 
+# the bodies of responses with these content types are only needed 
+# for their md5, and are dropped after they have been hashed
+BINARY_CONTENT_TYPES = ('image/', 'audio/', 'video/', 'font/', 
+	'application/octet-stream', 'application/zip', 'application/gzip', 
+	'application/x-gzip', 'application/x-tar', 'application/x-rar-compressed',
+	'application/x-7z-compressed', 'application/x-shockwave-flash', 'application/pdf')
+
+
+class ResponseBody(object):
+	# A response body which is read in chunks. The md5 of the whole body is
+	# updated as the chunks arrive, but at most 'max_size' bytes of the body 
+	# are kept. If 'keep' is False, nothing is kept.
+
+	def __init__(self, max_size=None, keep=True):
+		self.max_size = max_size
+		self.keep = keep
+		self.truncated = False
+		self.chunks = []
+		self.size = 0
+		self.hash = hashlib.md5()
+
+
+	def add(self, chunk):
+		self.hash.update(chunk)
+		if not self.keep: return
+
+		if self.max_size is not None and self.size + len(chunk) > self.max_size:
+			chunk = chunk[:self.max_size - self.size]
+			self.truncated = True
+
+		self.chunks.append(chunk)
+		self.size += len(chunk)
+
+
+	def get_content(self):
+		return b''.join(self.chunks)
+
+
+	def get_md5(self):
+		return self.hash.hexdigest().lower()
+
+
+
+class ConnectionPool(object):
+	# A thread safe pool of HTTP/1.1 connections. Connections are kept
+	# open after a request (unless the server closes them), and are 
+	# reused for the next request to the same host.
+	# The number of connections to a single host is capped, and 
+	# get() blocks until a connection is returned to the pool.
+
+	def __init__(self, max_per_host=10, max_idle_time=30):
+		self.max_per_host = max_per_host
+		self.max_idle_time = max_idle_time
+
+		self.lock = threading.Lock()
+		self.idle = defaultdict(list)		# (protocol, host) -> [(connection, time last used)]
+		self.slots = {}						# (protocol, host) -> semaphore
+
+
+	def _get_slots(self, key):
+		with self.lock:
+			if not key in self.slots:
+				self.slots[key] = threading.BoundedSemaphore(self.max_per_host)
+
+			return self.slots[key]
+
+
+	def get(self, protocol, host):
+		# returns a connection and whether it has been used before
+		key = (protocol, host)
+		self._get_slots(key).acquire()
+
+		with self.lock:
+			while self.idle[key]:
+				conn, last_used = self.idle[key].pop()
+
+				# servers close idle connections after a while, so 
+				# connections that have been idle for too long are 
+				# discarded
+				if time.time() - last_used < self.max_idle_time:
+					return conn, True
+
+				conn.close()
+
+		if protocol == 'http':
+			return http.client.HTTPConnection(host), False
+		else:
+			return http.client.HTTPSConnection(host), False
+
+
+	def put(self, protocol, host, conn, reusable):
+		# return a connection to the pool. The connection is 
+		# closed if it cannot be used for another request
+		key = (protocol, host)
+		if reusable:
+			with self.lock:
+				self.idle[key].append((conn, time.time()))
+		else:
+			conn.close()
+
+		self._get_slots(key).release()
+
+
+	def close(self):
+		with self.lock:
+			for key in self.idle:
+				for conn, _ in self.idle[key]:
+					conn.close()
+
+			self.idle.clear()
+
+
+
 class PageFetcher(object):
 	
-	def __init__(self, address, user_agent=None):
+	def __init__(self, address, user_agent=None, pool=None, max_body_size=None):
 		# init the host and protocol
 		self.host = None
 		self.protocol = 'http' # default to http
@@ -89,6 +425,14 @@ class PageFetcher(object):
 
 		self.max_redirs = 10
 
+		# connections are borrowed from the pool if it is set,
+		# otherwise a new connection is made for every request
+		self.pool = pool
+
+		# only this many bytes of a body are kept. 'None' keeps all
+		self.max_body_size = max_body_size
+		self.chunk_size = 64*1024
+
 
 	def check_out_of_scope(self, host):
 		if not (host == self.host or self.host == None):
@@ -157,83 +501,128 @@ class PageFetcher(object):
 		return (proto, host, path, True)
 
 
-	def _clean_page_404(self, page):
-		# this the same method nmap's http.lua uses for error page detection
-		# nselib/http.lua: clean_404
-		# remove information from the page that might not be static
-		
-		# time
-		page = re.sub(b'(\d?\d:?){2,3}', b'',page)
-		page = re.sub(b'AM', b'',page, flags=re.IGNORECASE)
-		page = re.sub(b'PM', b'',page, flags=re.IGNORECASE)
-
-		# date with 4 digit year
-		page = re.sub(b'(\d){8}', '',page)
-		page = re.sub(b'\d{4}-\d{2}-\d{2}', b'',page)
-		page = re.sub(b'\d{4}/\d{2}/\d{2}', b'',page)
-		page = re.sub(b'\d{2}-\d{2}-\d{4}', b'',page)
-		page = re.sub(b'\d{2}/\d{2}/\d{4}', b'',page)
-
-		# date with 2 digit year
-		page = re.sub( b'(\d){6}', '',page)
-		page = re.sub( b'\d{2}-\d{2}-\d{2}', b'',page)
-		page = re.sub( b'\d{2}/\d{2}/\d{2}', b'',page)
-		
-		# links and paths
-		page = re.sub( b'/[^ ]+',  b'', page)
-		page = re.sub( b'[a-zA-Z]:\\[^ ]+',  b'', page)
+	def _send(self, protocol, host, path, headers):
+		# returns the connection and the response
+		if self.pool is None:
+			# create correct Connection
+			http_con  = http.client.HTTPConnection
+			https_con = http.client.HTTPSConnection
 
-		# return the fingerprint of the stripped page 
-		return hashlib.md5(page).hexdigest().lower()
+			conn = http_con(host) if protocol == 'http' else https_con(host)
+			conn.request("GET", path, headers=headers)
+			return conn, conn.getresponse()
 
+		conn, reused = self.pool.get(protocol, host)
+		try:
+			conn.request("GET", path, headers=headers)
+			return conn, conn.getresponse()
 
-	def request(self, protocol, host, path):
-		
-		http_con  = http.client.HTTPConnection
-		https_con = http.client.HTTPSConnection
+		except (http.client.HTTPException, ConnectionError) as e:
+			conn.close()
+
+			# a connection from the pool might have been closed by the
+			# server since it was last used. In that case the request 
+			# is retried on a new connection
+			if reused:
+				self.pool.put(protocol, host, conn, False)
+				return self._send(protocol, host, path, headers)
+
+			self.pool.put(protocol, host, conn, False)
+			raise
+
+		except:
+			self.pool.put(protocol, host, conn, False)
+			raise
 
-		# create correct Connection
-		conn = http_con(host) if protocol == 'http' else https_con(host)
-		conn.request("GET", path)
-		r1 = conn.getresponse()
 
+	def _release(self, protocol, host, conn, reusable):
+		if self.pool is None:
+			conn.close()
+		else:
+			self.pool.put(protocol, host, conn, reusable)
+
+
+	def create_body(self, headers):
+		# create a ResponseBody for the response. 
+		# 'headers' is a list of (name, value) pairs
+		content_type = ''
+		for name, value in headers:
+			if name.lower() == 'content-type':
+				content_type = value.lower()
+
+		is_binary = content_type.startswith(BINARY_CONTENT_TYPES)
+		return ResponseBody(self.max_body_size, keep=not is_binary)
+
+
+	def create_request(self, protocol, host, path, status, reason, headers, body):
+		# create a Request from a response. 
+		# 'headers' is a list of (name, value) pairs and 'body' a ResponseBody
 		R = Request()
 
 		R.protocol = protocol
 		R.host = host
 		R.url = path
-		R.status = {'code': r1.status, 'text': r1.reason}
-		R.headers = {pair[0].lower():pair[1] for pair in r1.getheaders()}
+		R.status = {'code': status, 'text': reason}
+		R.headers = {pair[0].lower():pair[1] for pair in headers}
+
+		R.set_body(body.get_content())
+		R.md5 = body.get_md5()
+		R.truncated = body.truncated
+		R.dropped = not body.keep
+
+		return R
+
+
+	def request(self, protocol, host, path, headers=None):
+		# 'headers' are extra headers to send with the request
+		conn, r1 = self._send(protocol, host, path, headers or {})
+		body = self.create_body(r1.getheaders())
 	
-		body = r1.read()
+		try:
+			chunk = r1.read(self.chunk_size)
+			while chunk:
+				body.add(chunk)
+				chunk = r1.read(self.chunk_size)
+		except:
+			self._release(protocol, host, conn, False)
+			raise
 
-		R.set_body(body)
-		R.md5 = hashlib.md5(body).hexdigest().lower()
-		R.md5_404 = self._clean_page_404(body)
+		self._release(protocol, host, conn, not r1.will_close)
 
-		conn.close()
+		return self.create_request(protocol, host, path, r1.status, r1.reason, r1.getheaders(), body)
 
-		return R 
 
+	def get_redirect(self, response):
+		# returns the parts of the location the response redirects to,
+		# or None if the response is not a redirect to a page in scope
+		location = 'Location'.lower()
+		if not location in response.headers:
+			return None
+
+		protocol, host, path, in_scope = self.get_parts(response.headers[location])
+		if not in_scope:
+			return None
+
+		return protocol, host, path
 
-	def get(self):
-		r = self.request(self.protocol, self.host, self.path)
+
+	def get(self, headers=None):
+		# 'headers' are only sent with the first request, and not
+		# when following redirects
+		r = self.request(self.protocol, self.host, self.path, headers)
 		hist = [r]
 
-		location = 'Location'.lower()
 		redirs = 0
-		while location in r.headers and redirs < self.max_redirs:
-			address = r.headers[location]
-			protocol, host, path, in_scope = self.get_parts(address)
-			
-			if in_scope:
-				r = self.request(protocol, host, path)
-				hist.append(r)
-			else:
+		while redirs < self.max_redirs:
+			redirect = self.get_redirect(r)
+			if redirect is None:
 				break
 
+			r = self.request(*redirect)
+			hist.append(r)
+
 			redirs += 1
 
 		r.history = hist[:-1]
 
-		return r
\ No newline at end of file
+		return r
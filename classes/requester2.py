@@ -2,43 +2,91 @@ import queue, threading, time, hashlib,sys, re
 import urllib.request
 from classes.cache import Cache
 from classes.results import Results
-from classes.request import PageFetcher, Request
+from classes.request import PageFetcher, Request, ConnectionPool
+
+
+class InFlight(object):
+	# keeps track of the URLs that are being fetched, such that
+	# concurrent requests for the same URL wait for a single fetch
+	# instead of fetching the URL again
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.urls = {}		# url -> event set when the fetch is done
+
+
+	def claim(self, url):
+		# returns None if the caller should fetch the URL, otherwise 
+		# an event that is set when the fetch by another worker is done
+		with self.lock:
+			if url in self.urls:
+				return self.urls[url]
+
+			self.urls[url] = threading.Event()
+			return None
+
+
+	def release(self, url):
+		with self.lock:
+			self.urls.pop(url).set()
+
 
 
 class RequesterThread(threading.Thread):
-	def __init__(self, id, queue, cache, requested):
+	def __init__(self, id, queue, cache, pool, inflight, max_body_size):
 		threading.Thread.__init__(self)
 		self.id = id
 		self.queue = queue
 		self.cache = cache
-		self.requested = requested
+		self.pool = pool
+		self.inflight = inflight
+		self.max_body_size = max_body_size
 		self.kill = False
 
 	def make_request(self, item):
 		host = item['host']
 		path = item['url']
 
-		fetcher = PageFetcher(host + path)
+		fetcher = PageFetcher(host + path, pool=self.pool, max_body_size=self.max_body_size)
 
 		# check if the URLs has been requested before
 		# if it has, don't make the request again, but fetch 
 		# it from the cache
-
-		if not fetcher.url in self.cache:
-			try:
-				# make the request, and add it to the cache
-				request = fetcher.get()
-
-				self.cache[fetcher.url] = request
-				self.cache[request.get_url()] = request
-				for r in request.history:
-					self.cache[r.get_url()] = request
-
-			except Exception as e:
-				#print(e)
-				request = None
-		else:
-			request = self.cache[fetcher.url]
+		if fetcher.url in self.cache:
+			return self.cache[fetcher.url]
+
+		# if another worker is fetching the URL, wait for it to finish. 
+		# If that fetch failed, the URL is not in the cache
+		done = self.inflight.claim(fetcher.url)
+		if done is not None:
+			done.wait()
+			return self.cache[fetcher.url] if fetcher.url in self.cache else None
+
+		try:
+			# the URL might have been fetched by another worker between
+			# the check and the claim
+			if fetcher.url in self.cache:
+				return self.cache[fetcher.url]
+
+			# make the request, and add it to the cache. If an expired
+			# response is cached for the URL, the server is asked to
+			# only send the response if it has changed
+			stale = self.cache.get_stale(fetcher.url)
+			request = fetcher.get(None if stale is None else stale.get_validators())
+			if stale is not None and request.status['code'] == 304:
+				request = stale
+
+			self.cache[fetcher.url] = request
+			self.cache[request.get_url()] = request
+			for r in request.history:
+				self.cache[r.get_url()] = request
+
+		except Exception as e:
+			#print(e)
+			request = None
+
+		finally:
+			self.inflight.release(fetcher.url)
 
 		return request
 
@@ -49,78 +97,128 @@ class RequesterThread(threading.Thread):
 				self.queue.task_done()
 				break
 
-			response = self.make_request(item)
-			if response is None:
-				self.queue.task_done()
-				continue
+			# skip the request if the stream it belongs to is closed
+			if item['cancel'].is_set():
+				response = None
+			else:
+				response = self.make_request(item)
 
-			self.requested.put( (item['fps'], response ) )
+			item['results'].put( (item['fps'], response) )
 			self.queue.task_done()
 
 
 
 class Requester(object):
 	def __init__(self, options, data):
-		self.threads = None
+		self.threads = options['threads']
+		self.window = options['threads']
+
+		# the window of the streams that make every request, instead of
+		# stopping once something is found
+		self.max_window = options['threads']
 		self.workers = []
 		self.host = options['host']
-		self.find_404s = False
+		self.max_body_size = options['max_body_size']
 
 		self.cache = data['cache']
 		self.queue = queue.Queue()
 		self.requested = queue.Queue()
 
+		# the connections are shared by all the threads
+		self.pool = ConnectionPool(max_per_host=options['threads'])
+
+		# the URLs that are being fetched by the threads
+		self.inflight = InFlight()
+
 
 	# set the fingerprints for the requester to get.	
 	# fps should be a list of lists of fingerprints:
 	# [ [fp, fp, fp], [fp, fp, ...], ...]
 	# each fingerprinter in the innerlist must have the same URL
-	# The number of elements in the outer list equals the number
-	# of threads used
 	def set_fingerprints(self, fps):
 		self.fps = fps
-		self.threads = len(fps)
-
 
-	def set_find_404(self, find_404s):
-		self.find_404s = find_404s
 
 	def run(self):
+		# make the requests. The responses are added to self.requested
+		for fps, response in self.stream(self.fps, len(self.fps)):
+			if response is not None:
+				self.requested.put( (fps, response) )
 
-		for fp_list in self.fps:
-			self.queue.put({ "host": self.host, "url": fp_list[0]['url'], "fps": fp_list })
+		return self.requested
 
-		# add 'None' to queue - stops threads when no items are left
-		for i in range(self.threads): self.queue.put( None )
 
-		# start the threads
-		self.works = []
+	# the worker threads are started once, and are fed with 
+	# requests until the requester is shut down
+	def start(self):
 		for i in range(self.threads):
-			w = RequesterThread(i, self.queue, self.cache, self.requested)
+			w = RequesterThread(i, self.queue, self.cache, self.pool, self.inflight, self.max_body_size)
 			w.daemon = True
 			self.workers.append(w)
 			w.start()
 
-		# join when all work is done
-		self.queue.join()
 
-		# the define_404 should only be true during the 
-		# preprocessing. 
-		if not self.find_404s:
-			return self.requested
+	# stop the worker threads when the queued requests are done
+	def shutdown(self):
+		# add 'None' to queue - stops threads when no items are left
+		for w in self.workers: self.queue.put( None )
+		for w in self.workers: w.join()
+
+		self.workers = []
+		self.pool.close()
+
+
+	# stop the worker threads without waiting for the queued requests
+	def kill(self):
+		for w in self.workers:
+			w.kill = True
+			self.queue.put( None )
+
+		self.workers = []
+
+
+	# request the fingerprints, and yield (fps, response) tuples as soon 
+	# as each response arrives. The response is None if the request failed.
+	# At most 'window' requests are outstanding at any time. When the
+	# generator is closed, the requests that have not been started yet
+	# are cancelled. 'fps' is asked for more items after every response,
+	# even if it had run out before, so it can pick the next items based
+	# on the responses so far
+	def stream(self, fps, window=None):
+		if window is None: window = self.window
+
+		results = queue.Queue()
+		cancel = threading.Event()
+		fps = iter(fps)
+		outstanding = 0
+
+		try:
+			while True:
+				# keep the window filled
+				while outstanding < window:
+					fp_list = next(fps, None)
+					if fp_list is None: break
 
-		# if the define_404 flag is set, then the 
-		# supplied URLs are to be used for identification of 404 
-		# pages
-		else:
-			error_pages = queue.Queue()
-			while self.requested.qsize() > 0:
-				_,response = self.requested.get()
-				error_pages.put((response.md5_404, response.url))
+					self._submit({
+						"host": self.host, "url": fp_list[0]['url'], "fps": fp_list,
+						"results": results, "cancel": cancel
+					})
+					outstanding += 1
 
-			return error_pages
+				if outstanding == 0:
+					break
 
+				yield results.get()
+				outstanding -= 1
 
+		finally:
+			cancel.set()
 
 
+	# queue a request. When done, the worker puts (fps, response) 
+	# in the item's 'results' queue
+	def _submit(self, item):
+		if not self.workers:
+			self.start()
 
+		self.queue.put(item)
@@ -0,0 +1,368 @@
+import asyncio, ssl, threading
+from collections import defaultdict
+from classes.request import PageFetcher
+from classes.requester2 import Requester
+
+# wig - AsyncRequester
+#
+# An alternative to the threaded Requester, which makes the requests
+# from a single asyncio event loop. This allows for many more requests
+# in flight at the same time, without the memory and scheduling cost
+# of a thread per request.
+# The event loop runs in a background thread, so the requester has the
+# same blocking set_fingerprints/run interface as the threaded one, and
+# uses the same cache.
+# The streams of CMS and version detection keep as many requests in
+# flight as the threaded requester ('threads'), as these are closed as
+# soon as something is found, and the requests beyond that would be
+# wasted. The streams that make every request (see 'max_window') keep
+# up to 'concurrency' requests in flight.
+
+
+class AsyncConnectionPool(object):
+	# keeps idle keep-alive connections (reader, writer) for each host
+
+	def __init__(self):
+		self.idle = defaultdict(list)		# (protocol, host) -> [(reader, writer)]
+		self.ssl_context = ssl.create_default_context()
+
+
+	async def get(self, protocol, host):
+		# returns a connection and whether it has been used before
+		key = (protocol, host)
+		while self.idle[key]:
+			reader, writer = self.idle[key].pop()
+			if not reader.at_eof() and not writer.is_closing():
+				return reader, writer, True
+
+			writer.close()
+
+		if ':' in host:
+			hostname, port = host.rsplit(':', 1)
+			port = int(port)
+		else:
+			hostname = host
+			port = 80 if protocol == 'http' else 443
+
+		if protocol == 'http':
+			reader, writer = await asyncio.open_connection(hostname, port)
+		else:
+			reader, writer = await asyncio.open_connection(hostname, port, ssl=self.ssl_context, server_hostname=hostname)
+
+		return reader, writer, False
+
+
+	def put(self, protocol, host, reader, writer, reusable):
+		if reusable:
+			self.idle[(protocol, host)].append((reader, writer))
+		else:
+			writer.close()
+
+
+	def close(self):
+		for key in self.idle:
+			for _, writer in self.idle[key]:
+				writer.close()
+
+		self.idle.clear()
+
+
+
+class AsyncPageFetcher(PageFetcher):
+	# a PageFetcher that makes the requests with asyncio streams.
+	# Only the parts of HTTP/1.1 needed for GET requests are implemented
+
+	async def _read(self, reader, body, size):
+		# read 'size' bytes into the ResponseBody
+		while size > 0:
+			chunk = await reader.readexactly(min(size, self.chunk_size))
+			body.add(chunk)
+			size -= len(chunk)
+
+
+	async def _read_body(self, reader, status, headers):
+		# returns the ResponseBody and whether the connection can be reused
+		body = self.create_body(headers)
+
+		headers = {name.lower(): value for name, value in headers}
+		keep_alive = not headers.get('connection', '').lower() == 'close'
+
+		# these responses never have a body
+		if status == 204 or status == 304 or 100 <= status < 200:
+			return body, keep_alive
+
+		if 'chunked' in headers.get('transfer-encoding', '').lower():
+			while True:
+				line = await reader.readline()
+				size = int(line.split(b';')[0].strip(), 16)
+				if size == 0:
+					break
+
+				await self._read(reader, body, size)
+				await reader.readline()
+
+			# skip trailers
+			while not (await reader.readline()).strip() == b'':
+				pass
+
+			return body, keep_alive
+
+		if 'content-length' in headers:
+			await self._read(reader, body, int(headers['content-length']))
+			return body, keep_alive
+
+		# without a length, the body ends when the connection is closed
+		chunk = await reader.read(self.chunk_size)
+		while chunk:
+			body.add(chunk)
+			chunk = await reader.read(self.chunk_size)
+
+		return body, False
+
+
+	async def _send(self, protocol, host, path, headers):
+		# returns the status, reason, headers and body of the response
+		reader, writer, reused = await self.pool.get(protocol, host)
+
+		try:
+			request = 'GET %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: identity\r\n' % (path, host)
+			request += ''.join('%s: %s\r\n' % (name, value) for name, value in headers.items())
+			request += '\r\n'
+			writer.write(request.encode('latin-1'))
+			await writer.drain()
+
+			status_line = await reader.readline()
+			if not status_line:
+				raise ConnectionError('Connection closed')
+
+			version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+			status = int(status)
+
+			response_headers = []
+			while True:
+				line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+				if line == '':
+					break
+
+				name, value = line.split(':', 1)
+				response_headers.append((name.strip(), value.strip()))
+
+			body, keep_alive = await self._read_body(reader, status, response_headers)
+
+		except (ConnectionError, asyncio.IncompleteReadError) as e:
+			writer.close()
+
+			# a reused connection might have been closed by the server
+			# since it was last used, so the request is retried on a
+			# new connection
+			if reused:
+				return await self._send(protocol, host, path, headers)
+			raise
+
+		except:
+			writer.close()
+			raise
+
+		self.pool.put(protocol, host, reader, writer, keep_alive and version == 'HTTP/1.1')
+
+		return status, reason, response_headers, body
+
+
+	async def request(self, protocol, host, path, headers=None):
+		status, reason, headers, body = await self._send(protocol, host, path, headers or {})
+		return self.create_request(protocol, host, path, status, reason, headers, body)
+
+
+	async def get(self, headers=None):
+		r = await self.request(self.protocol, self.host, self.path, headers)
+		hist = [r]
+
+		redirs = 0
+		while redirs < self.max_redirs:
+			redirect = self.get_redirect(r)
+			if redirect is None:
+				break
+
+			r = await self.request(*redirect)
+			hist.append(r)
+
+			redirs += 1
+
+		r.history = hist[:-1]
+
+		return r
+
+
+
+class AsyncRequester(Requester):
+
+	def __init__(self, options, data):
+		super().__init__(options, data)
+		self.concurrency = options['concurrency']
+		self.max_window = self.concurrency
+		self.loop = None
+		self.thread = None
+		self.async_pool = None
+		self.semaphore = None
+		self.tasks = set()
+
+		# url -> future with the response of the task fetching the url
+		self.async_inflight = {}
+
+
+	def start(self):
+		# start the event loop in a background thread
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	async def _cancel_tasks(self):
+		# cancel the requests that are still outstanding, e.g. those of
+		# closed streams, and wait for them to finish
+		current = asyncio.current_task()
+		tasks = [task for task in asyncio.all_tasks() if not task is current]
+		for task in tasks:
+			task.cancel()
+
+		await asyncio.gather(*tasks, return_exceptions=True)
+
+
+	async def _close(self):
+		await self._cancel_tasks()
+		await self.loop.shutdown_default_executor()
+
+		if self.async_pool is not None:
+			self.async_pool.close()
+
+
+	def shutdown(self):
+		if self.loop is None: return
+
+		asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.loop.close()
+		self.loop = None
+
+
+	# stop the event loop once the outstanding requests are cancelled,
+	# without waiting for it
+	def kill(self):
+		if self.loop is None: return
+
+		loop = self.loop
+		future = asyncio.run_coroutine_threadsafe(self._cancel_tasks(), loop)
+		future.add_done_callback(lambda f: loop.call_soon_threadsafe(loop.stop))
+		self.loop = None
+
+
+	# the cache is backed by SQLite, so it is used from the threads of
+	# the default executor, and does not block the requests in flight
+	def _get_cached(self, url):
+		try:
+			return self.cache[url]
+		except KeyError:
+			return None
+
+
+	def _add_to_cache(self, url, request):
+		self.cache[url] = request
+		self.cache[request.get_url()] = request
+		for r in request.history:
+			self.cache[r.get_url()] = request
+
+
+	async def _fetch(self, fetcher, cancel):
+		# returns the response for the URL of the fetcher, or None if
+		# the request failed or was skipped, as the stream it belongs 
+		# to was closed
+		url = fetcher.url
+
+		# if the URL is being fetched by another task, wait for that
+		# fetch instead of making the request again. The URL is claimed
+		# before the cache is checked, as the other task might add the
+		# response to the cache while this one waits for the lookup
+		while url in self.async_inflight:
+			future = self.async_inflight[url]
+			try:
+				return await asyncio.shield(future)
+			except asyncio.CancelledError:
+				# the other task skipped the request, so try again
+				if not future.cancelled():
+					raise
+
+		future = self.loop.create_future()
+		self.async_inflight[url] = future
+		request = None
+		skipped = False
+		try:
+			# check if the URLs has been requested before
+			# if it has, don't make the request again, but fetch
+			# it from the cache
+			request = await self.loop.run_in_executor(None, self._get_cached, url)
+			if request is None:
+				async with self.semaphore:
+					# skip the request if the stream it belongs to
+					# was closed while waiting
+					if cancel.is_set():
+						raise asyncio.CancelledError()
+
+					# make the request, and add it to the cache. If an 
+					# expired response is cached for the URL, the server is
+					# asked to only send the response if it has changed
+					stale = await self.loop.run_in_executor(None, self.cache.get_stale, url)
+					request = await fetcher.get(None if stale is None else stale.get_validators())
+					if stale is not None and request.status['code'] == 304:
+						request = stale
+
+				await self.loop.run_in_executor(None, self._add_to_cache, url, request)
+
+		except asyncio.CancelledError:
+			skipped = True
+
+		except Exception as e:
+			request = None
+
+		finally:
+			del self.async_inflight[url]
+			if skipped:
+				future.cancel()
+			else:
+				future.set_result(request)
+
+		return request
+
+
+	async def _make_request(self, item):
+		host = item['host']
+		path = item['url']
+
+		fetcher = AsyncPageFetcher(host + path, pool=self.async_pool, max_body_size=self.max_body_size)
+
+		request = await self._fetch(fetcher, item['cancel'])
+		item['results'].put( (item['fps'], request) )
+
+
+	async def _create_pool(self):
+		# the pool and semaphore are created inside the loop, as they
+		# are bound to it
+		self.async_pool = AsyncConnectionPool()
+		self.semaphore = asyncio.Semaphore(self.concurrency)
+
+
+	def _create_task(self, item):
+		# the event loop only keeps weak references to tasks, so a 
+		# reference is kept until the task is done
+		task = self.loop.create_task(self._make_request(item))
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+
+
+	def _submit(self, item):
+		if self.loop is None:
+			self.start()
+			asyncio.run_coroutine_threadsafe(self._create_pool(), self.loop).result()
+
+		self.loop.call_soon_threadsafe(self._create_task, item)
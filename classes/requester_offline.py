@@ -0,0 +1,31 @@
+from classes.request import PageFetcher
+from classes.requester2 import Requester
+
+# wig - OfflineRequester
+#
+# A requester that never makes requests, but only returns the responses
+# that are in the cache. It is used when the cache has been filled from
+# an archive (see archive.py), such that a site can be fingerprinted
+# from captured traffic. URLs that are not in the cache fail, as if
+# the request had failed.
+
+
+class OfflineRequester(Requester):
+
+	def start(self):
+		pass
+
+
+	def shutdown(self):
+		pass
+
+
+	def kill(self):
+		pass
+
+
+	def _submit(self, item):
+		url = PageFetcher(item['host'] + item['url']).url
+		response = self.cache[url] if url in self.cache else None
+
+		item['results'].put( (item['fps'], response) )
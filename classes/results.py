@@ -1,4 +1,5 @@
 from collections import defaultdict, Counter
+from fractions import Fraction
 from classes.color import Color
 from classes.sitemap import Sitemap
 import pprint
@@ -25,29 +26,70 @@ class Results(object):
 		self.md5_matches = defaultdict(lambda: defaultdict(lambda: set()))
 		#		           ^ Url               ^ cms               ^ versions
 
+		# the md5 scores are kept up to date as matches arrive. When a
+		# version is added to the hits of a URL, the score of every other
+		# version with a hit at the URL changes as well. To avoid updating
+		# these for every single match, the (url, cms) pairs with new hits
+		# are only applied when the scores are read. Fractions are used,
+		# so versions with the same hits have exactly the same score
+		self.md5_scores = defaultdict(lambda: defaultdict(Fraction))
+		#		          ^ cms               ^ version
+		self.md5_applied = {}		# (url, cms) -> the versions in the md5 scores
+		self.md5_pending = set()	# (url, cms) pairs with new hits
+
+		# the cmss with at least one match
+		self.matched_cms = set()
+
 		self.sitemap = Sitemap()
 
 
-	def _calc_md5_score(self):
+	def _update_md5_scores(self):
+		for url, cms in self.md5_pending:
+			scores = self.md5_scores[cms]
+			versions = self.md5_matches[url][cms]
+			old_versions = self.md5_applied.get((url, cms), frozenset())
+
+			# the hits that were already applied have their score 
+			# lowered, and the new hits are added
+			if old_versions:
+				delta = Fraction(1, len(versions)) - Fraction(1, len(old_versions))
+				for version in old_versions:
+					scores[version] += delta
+
+			for version in versions - old_versions:
+				scores[version] += Fraction(1, len(versions))
+
+			self.md5_applied[(url, cms)] = frozenset(versions)
+
+		self.md5_pending.clear()
 
-		# calculate the final scores for md5 fingerprints, and add
-		# them to the final scores 
-		for url in self.md5_matches:
-			for cms in self.md5_matches[url]:
 
-				# get the number of 'hits' for a specific CMS and URL
-				number_of_hits = len(self.md5_matches[url][cms])
+	def _get_cms_scores(self, cms):
+		# the scores of the versions of the cms, of all fingerprint types
+		self._update_md5_scores()
 
-				# update the score for thencms version 
-				for version in self.md5_matches[url][cms]:
-					self.scores['CMS'][cms][version] += (1 / number_of_hits)
+		scores = Counter(self.scores.get('CMS', {}).get(cms, {}))
+		for version, score in self.md5_scores[cms].items():
+			scores[version] += score
 
+		return scores
+
+
+	def confidence(self, cms):
+		# how far the best version of the cms is ahead of the second best, 
+		# from 0 (tied, or no matches) to 1 (no other versions match)
+		versions = self._get_cms_scores(cms).most_common(2)
+		if len(versions) == 0 or versions[0][1] <= 0:
+			return 0.0
+
+		if len(versions) == 1:
+			return 1.0
+
+		return float(1 - versions[1][1] / versions[0][1])
 
 
 	def found_match(self,cms):
-		in_scores = cms in self.scores['CMS']
-		in_md5 = cms in set([cms for url in self.md5_matches for cms in self.md5_matches[url]])
-		return in_scores or in_md5
+		return cms in self.matched_cms
 
 
 	def add_cms(self, fp):
@@ -71,6 +113,7 @@ class Results(object):
 		# fingerprint match
 		if fp['type'] == 'md5':
 			self.md5_matches[url][cms].add(ver)
+			self.md5_pending.add((url, cms))
 			matched = fp['md5']
 
 		# if the type is either 'string' or 'regex' then the match show
@@ -93,6 +136,7 @@ class Results(object):
 			else:
 				self.scores['CMS'][cms][ver] += 1
 
+		self.matched_cms.add(cms)
 		self.printer.print('- Found match: %s - %s %s - %s: %s' % (url, cms, ver, fp['type'], matched), 5)
 		
 
@@ -151,6 +195,9 @@ class Results(object):
 		else:
 			self.scores[category][name][version] += weight
 
+		if category == 'CMS' and not version == None:
+			self.matched_cms.add(name)
+
 
 	def set_width(self, width):
 		self.width = width
@@ -165,20 +212,24 @@ class Results(object):
 
 
 	def get_results(self):
-		self._calc_md5_score()
+		# the md5 scores are added to a copy of the scores
+		scores = {category: dict(self.scores[category]) for category in self.scores}
+		for cms in sorted(self.matched_cms):
+			scores.setdefault('CMS', {})[cms] = self._get_cms_scores(cms)
 
 		results = {}
 		self.printer.print('Results:', 2)
-		for category in self.scores:
+		for category in scores:
 			if category not in results: results[category] = {}
 			
-			for plugin in sorted(self.scores[category]):
-				v = self.scores[category][plugin]
+			for plugin in sorted(scores[category]):
+				v = scores[category][plugin]
 
 				versions = sorted(v.items(), key=lambda x:x[1], reverse=True)
 				
 				for i in versions:
-					self.printer.print('- %s: %s - Version: %s [%s]' % (category, plugin, i[0], i[1]), 2)
+					score = float(i[1]) if isinstance(i[1], Fraction) else i[1]
+					self.printer.print('- %s: %s - Version: %s [%s]' % (category, plugin, i[0], score), 2)
 
 				relevant = sorted(i[0] for i in versions if i[1] == versions[0][1])
 				results[category][plugin] = relevant
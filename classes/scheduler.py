@@ -0,0 +1,345 @@
+import heapq, math
+from collections import defaultdict, Counter
+
+# wig - ProbeScheduler
+#
+# Decides in which order the URLs are requested during CMS detection.
+# Instead of a fixed order, the URL that is most likely to lead to a
+# detection is requested next. This depends on:
+#
+# - the CMSs that have fingerprints for the URL (a URL used by more
+#   CMSs is more likely to exist)
+# - the share of the versions of each CMS that match at the URL, as a
+#   file that was only present in a few versions is unlikely to be found.
+#   Strings and regexes that are not tied to a version are assumed to
+#   match rarely, as they often look for pages that have been removed
+# - how distinctive the fingerprints are. An md5 or string that is
+#   used by several CMSs does not tell them apart
+# - the weight of each CMS. This is lowered for every URL of the CMS that
+#   is requested, and set to 0 once the CMS has been detected
+#
+# A URL is assumed to be missing as soon as it is handed out, as many
+# requests are made at the same time: otherwise all of them would be
+# spent on the CMS with the most URLs before the first one is answered.
+# If the page turns out to exist, the weight is restored.
+#
+# The weights only decrease while the URLs are handed out, so the score
+# of a URL only decreases as well. This allows the scores to be updated
+# lazily: a URL is only rescored when it reaches the top of the heap.
+# When a weight is restored, the URLs of the CMS are pushed again.
+
+
+class ProbeScheduler(object):
+
+	# the share of the versions of a CMS that have the file, which is
+	# assumed to be missing anyway, e.g. as it has been removed
+	missing_rate = 0.25
+
+	# the share of the versions of a CMS that are assumed to match a
+	# string or regex fingerprint that is not tied to a version
+	match_rate = 0.3
+
+	# the factor the weight of a prioritized CMS is multiplied with, such
+	# that its other URLs follow, until a few of them turn out to be missing
+	priority_weight = 100
+
+	# the number of URLs with only md5 fingerprints of a prioritized CMS
+	# that are requested first, along with its string and regex URLs
+	priority_urls = 5
+
+	def __init__(self, fingerprints, matcher):
+		self.fingerprints = fingerprints
+		self.matcher = matcher
+
+		# url -> [(cms, coverage, gain), ...]
+		self.stats = {}
+
+		# cms -> weight
+		self.weights = {}
+
+		# cms -> [url, ...]
+		self.urls = defaultdict(list)
+
+		# url -> position in the ordered list, used to break ties
+		self.positions = {}
+
+		# [(url, cms), ...] the URLs of the prioritized CMSs that are
+		# requested first
+		self.first = []
+
+		self.heap = []
+		self.done = set()
+
+		self._create_stats()
+
+
+	def _create_stats(self):
+		all_fps = self.fingerprints.get_all()
+
+		# the versions of every cms, and the cmss using every md5 or string
+		versions = defaultdict(set)
+		users = defaultdict(set)
+		for fp in all_fps:
+			if fp['type'] == 'md5':
+				versions[fp['cms']].add(fp['output'])
+			users[(fp['type'], fp[fp['type']])].add(fp['cms'])
+
+		for position, fps in enumerate(self.fingerprints.get_ordered_list()):
+			url = fps[0]['url']
+			self.positions[url] = position
+
+			by_cms = defaultdict(list)
+			for fp in fps:
+				by_cms[fp['cms']].append(fp)
+
+			self.stats[url] = []
+			for cms, cms_fps in by_cms.items():
+				self.weights[cms] = 1.0
+				self.urls[cms].append(url)
+
+				coverage = self._get_coverage(cms_fps, versions[cms])
+
+				distinct = sum(1 / len(users[(fp['type'], fp[fp['type']])]) for fp in cms_fps) / len(cms_fps)
+
+				self.stats[url].append((cms, coverage, coverage * distinct))
+
+
+	def _get_coverage(self, fps, versions):
+		# the share of the versions of the cms that are expected to match
+		# at the URL. An md5 only matches its own version, and a string
+		# with a version matches the versions it is the prefix of, e.g.
+		# '5' for '5.1' and '5.2'. A string or regex without a version
+		# might match any version, but most of these look for pages that
+		# are often removed, so they are assumed to rarely match
+		matching = set()
+		coverage = 0.0
+		for fp in fps:
+			if fp['type'] == 'md5':
+				matching.add(fp['output'])
+			elif fp['type'] == 'string' and versions and not fp['output'] in ('', '%s'):
+				matching |= {v for v in versions if v.startswith(fp['output'])} or {fp['output']}
+			else:
+				coverage = self.match_rate
+
+		if versions:
+			coverage = max(coverage, min(1.0, len(matching) / len(versions)))
+
+		return coverage
+
+
+	def get_score(self, url):
+		return sum(self.weights[cms] * gain for cms, _, gain in self.stats[url])
+
+
+	def _get_miss_factor(self, coverage):
+		# the factor the weight of a cms is multiplied with when a
+		# URL, which is present in 'coverage' of its versions, is missing
+		return 1 - (1 - self.missing_rate) * coverage
+
+
+	def _push(self, url):
+		heapq.heappush(self.heap, (-self.get_score(url), self.positions[url], url))
+
+
+	def prioritize(self, cms_list):
+		# must be called before the URLs are handed out, as the scores 
+		# are assumed to only decrease while they are
+		for cms in cms_list:
+			if not cms in self.weights:
+				continue
+
+			self.weights[cms] *= self.priority_weight
+
+			urls = [fps[0]['url'] for fps in self.fingerprints.get_fingerprints_for_cms(cms) if fps[0]['url'] in self.positions and not all(fp['type'] == 'md5' for fp in fps)]
+			coverage = {url: c for url in self.urls[cms] for other, c, _ in self.stats[url] if other == cms}
+			md5_urls = sorted((url for url in self.urls[cms] if not url in urls), key=lambda url: (-coverage[url], self.positions[url]))
+
+			self.first += [(url, cms) for url in urls + md5_urls[:self.priority_urls]]
+
+
+	def _decays(self, url, cms):
+		# the weight of a prioritized CMS does not decay while its first
+		# URLs are handed out, as these are not picked by their scores
+		return not (url, cms) in self.first
+
+
+	def update(self, fps, response, matches):
+		# update the weights with the result of a request.
+		# The URL was assumed to be missing when it was handed out, so
+		# only detections and pages that exist change the weights. If the
+		# request failed nothing is known, which is handled the same way
+		url = fps[0]['url']
+		if matches:
+			for fp in matches:
+				self.weights[fp['cms']] = 0.0
+
+		elif response is None or not self.matcher.is_404(response):
+			for cms, coverage, _ in self.stats[url]:
+				if self._decays(url, cms):
+					self.weights[cms] /= self._get_miss_factor(coverage)
+
+				for other in self.urls[cms]:
+					if not other in self.done:
+						self._push(other)
+
+
+	def _hand_out(self, url):
+		self.done.add(url)
+		for cms, coverage, _ in self.stats[url]:
+			if self._decays(url, cms):
+				self.weights[cms] *= self._get_miss_factor(coverage)
+
+		return self.fingerprints.get_fingerprints_for_url(url)
+
+
+	def __iter__(self):
+		self.done = set()
+		self.heap = []
+		for url in self.positions:
+			self._push(url)
+
+		# the URLs of a prioritized CMS are skipped once it is detected
+		for url, cms in self.first:
+			if not url in self.done and self.weights[cms] > 0:
+				yield self._hand_out(url)
+
+		while self.heap:
+			_, position, url = heapq.heappop(self.heap)
+			if url in self.done:
+				continue
+
+			# the score might have decreased since it was pushed. If so,
+			# it is pushed back, unless it is still the highest
+			entry = (-self.get_score(url), position, url)
+			if self.heap and entry > self.heap[0]:
+				heapq.heappush(self.heap, entry)
+				continue
+
+			yield self._hand_out(url)
+
+
+
+# wig - VersionScheduler
+#
+# Decides which URLs are requested during version detection of a CMS.
+# When every matching response is consistent with a single version, the
+# versions with the highest score are the ones that match at every URL
+# where a known md5 was found. These versions are kept as candidates,
+# and the URL whose md5s split the candidates the most is requested
+# next. Once no URL is left that could split the candidates, the result
+# cannot change anymore, so no more requests are made.
+#
+# URLs with 'string' and 'regex' fingerprints are always requested, as
+# these add to the scores directly. If the responses contradict the
+# fingerprints, every remaining URL is requested.
+
+
+class VersionScheduler(object):
+
+	# the max number of URLs with md5 fingerprints that are requested at
+	# the same time. More requests in flight save round trips, but each
+	# is chosen without knowing the responses to the others
+	max_pending = 4
+
+	def __init__(self, fingerprints):
+		# url -> list of fingerprints
+		self.fps = {}
+
+		# url -> {version: set of md5s}. URLs that are not in this dict
+		# are always requested
+		self.md5s = {}
+
+		self.order = []
+		for fps in fingerprints:
+			url = fps[0]['url']
+			self.fps[url] = fps
+			self.order.append(url)
+
+			# a version might have several md5s at a URL
+			if all(fp['type'] == 'md5' for fp in fps):
+				md5s = defaultdict(set)
+				for fp in fps:
+					md5s[fp['output']].add(fp['md5'])
+				self.md5s[url] = {version: frozenset(md5s[version]) for version in md5s}
+
+		self.candidates = {version for versions in self.md5s.values() for version in versions}
+		self.pending = []
+		self.issued = set()
+		self.matched = False
+		self.exhaustive = False
+
+
+	def _get_entropy(self, keys):
+		counts = Counter(keys)
+		total = len(keys)
+
+		return -sum(n / total * math.log(n / total) for n in counts.values())
+
+
+	def _get_next(self):
+		# returns the next URL to request, or None if the responses for
+		# the pending requests are needed to decide
+		remaining = [url for url in self.order if not url in self.issued]
+
+		for url in remaining:
+			if self.exhaustive or not url in self.md5s:
+				return url
+
+		if len(self.pending) >= self.max_pending:
+			return None
+
+		# the candidates are split by the md5s of the pending URLs. The
+		# next URL is the one that splits the parts the most. A version
+		# that does not have the file is a part of its own
+		candidates = sorted(self.candidates)
+		pending = [tuple(self.md5s[url].get(v) for url in self.pending if url in self.md5s) for v in candidates]
+		current = self._get_entropy(pending)
+
+		best, best_gain = None, 1e-9
+		for url in remaining:
+			md5s = self.md5s[url]
+			gain = self._get_entropy([(key, md5s.get(v)) for key, v in zip(pending, candidates)]) - current
+			if gain > best_gain:
+				best, best_gain = url, gain
+
+		# the version is only added to the results once an md5 has
+		# matched, so until then the URLs that most candidates have are
+		# requested, even if they do not split the candidates
+		if best is None and not self.matched and not self.pending:
+			best = max(remaining, key=lambda url: sum(v in self.md5s[url] for v in candidates), default=None)
+
+		return best
+
+
+	def update(self, fps, response, matches):
+		# keep the candidates that match the response. Missing pages and
+		# unknown md5s do not rule out any versions, as files are often
+		# removed or changed
+		url = fps[0]['url']
+		self.pending.remove(url)
+
+		versions = {fp['output'] for fp in matches if fp['type'] == 'md5'}
+		if not url in self.md5s or not versions:
+			return
+
+		self.matched = True
+		if self.candidates & versions:
+			self.candidates &= versions
+		else:
+			self.exhaustive = True
+
+
+	# the requester asks for the next URL after every response, so a URL
+	# can be returned after StopIteration has been raised
+	def __iter__(self):
+		return self
+
+
+	def __next__(self):
+		url = self._get_next()
+		if url is None:
+			raise StopIteration
+
+		self.issued.add(url)
+		self.pending.append(url)
+		return self.fps[url]
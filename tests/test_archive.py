@@ -0,0 +1,198 @@
+import base64, contextlib, gzip, hashlib, io, json, os, tempfile, unittest
+from classes.archive import ArchiveLoader, HarReader, WarcReader, open_archive
+from classes.cache import Cache
+
+
+class Printer(object):
+	def print(self, *args, **kwargs):
+		pass
+
+
+
+def har_entry(url, status, body=b'', headers=(), encoding=None, mime_type='text/html'):
+	content = {'mimeType': mime_type}
+	if encoding == 'base64':
+		content['text'] = base64.b64encode(body).decode('ascii')
+		content['encoding'] = 'base64'
+	else:
+		content['text'] = body.decode('utf-8')
+
+	return {
+		'request': {'method': 'GET', 'url': url},
+		'response': {
+			'status': status,
+			'statusText': 'OK' if status == 200 else '',
+			'headers': [{'name': name, 'value': value} for name, value in headers],
+			'content': content
+		}
+	}
+
+
+def warc_record(url, block, warc_type='response', content_type='application/http; msgtype=response', length=True):
+	headers = ['WARC/1.0', 'WARC-Type: ' + warc_type, 'WARC-Target-URI: ' + url, 'Content-Type: ' + content_type]
+	if length:
+		headers.append('Content-Length: %d' % (len(block), ))
+
+	return '\r\n'.join(headers).encode('utf-8') + b'\r\n\r\n' + block + b'\r\n\r\n'
+
+
+def http_response(status, body, headers=()):
+	lines = ['HTTP/1.1 %d %s' % (status, 'OK' if status == 200 else 'Found'), 'Content-Length: %d' % (len(body), )]
+	lines += ['%s: %s' % header for header in headers]
+	return '\r\n'.join(lines).encode('latin-1') + b'\r\n\r\n' + body
+
+
+
+class ArchiveTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+
+	def write(self, name, data):
+		file_name = os.path.join(self.dir.name, name)
+		with open(file_name, 'wb') as fh:
+			fh.write(data)
+
+		return file_name
+
+
+	def load(self, file_name):
+		# returns the cache filled from the archive, and the result of
+		# loading it
+		cache = Cache()
+		options = {'archive': file_name, 'host': 'http://example.com/', 'max_body_size': None, 'printer': Printer()}
+		with contextlib.redirect_stdout(io.StringIO()) as output:
+			loaded = ArchiveLoader(options, {'cache': cache}).run()
+
+		self.output = output.getvalue()
+		return cache, loaded
+
+
+
+class TestHarReader(ArchiveTestCase):
+
+	def create_har(self):
+		entries = [
+			har_entry('http://example.com/', 200, b'<html>index</html>', [('Content-Type', 'text/html')]),
+			har_entry('http://example.com/old', 302, headers=[('Location', '/new')]),
+			har_entry('http://example.com/new', 200, b'<html>new</html>', [('Content-Type', 'text/html')]),
+			har_entry('http://example.com/logo.png', 200, b'\x89PNG\x00\xff', [('Content-Type', 'image/png')], encoding='base64'),
+			har_entry('http://other.com/', 200, b'other'),
+			har_entry('http://example.com/blocked', 0),
+			{'request': {'url': 'http://example.com/broken'}},
+		]
+		return self.write('site.har', json.dumps({'log': {'version': '1.2', 'entries': entries}}).encode('utf-8'))
+
+
+	def test_read(self):
+		# incomplete entries and entries without a response are skipped
+		file_name = self.create_har()
+		urls = [(url, status, body) for url, status, _, _, body in HarReader(file_name, chunk_size=16)]
+		self.assertEqual(urls, [
+			('http://example.com/', 200, b'<html>index</html>'),
+			('http://example.com/old', 302, b''),
+			('http://example.com/new', 200, b'<html>new</html>'),
+			('http://example.com/logo.png', 200, b'\x89PNG\x00\xff'),
+			('http://other.com/', 200, b'other'),
+		])
+		self.assertIsInstance(open_archive(file_name), HarReader)
+
+
+	def test_load(self):
+		cache, loaded = self.load(self.create_har())
+		self.assertTrue(loaded)
+
+		# the redirect is replaced by the response it ends up at, and is
+		# not a response of its own
+		self.assertIs(cache['http://example.com/old'], cache['http://example.com/new'])
+		self.assertEqual([r.url for r in cache['http://example.com/new'].history], ['/old'])
+		self.assertEqual(cache.get_num_urls(), 3)
+		self.assertEqual(sorted(r.url for r in cache.get_responses()), ['/', '/logo.png', '/new'])
+
+		# images are only matched by the md5 of the body
+		self.assertEqual(cache['http://example.com/logo.png'].md5, hashlib.md5(b'\x89PNG\x00\xff').hexdigest())
+		self.assertEqual(cache['http://example.com/'].body, '<html>index</html>')
+		self.assertNotIn('http://other.com/', cache)
+
+
+	def test_redirect_target_missing(self):
+		# the request would have failed, as the target is not captured
+		entries = [har_entry('http://example.com/old', 301, headers=[('Location', '/gone')])]
+		cache, loaded = self.load(self.write('site.har', json.dumps({'log': {'entries': entries}}).encode('utf-8')))
+		self.assertTrue(loaded)
+		self.assertNotIn('http://example.com/old', cache)
+		self.assertEqual(cache.get_num_urls(), 0)
+
+
+	def test_invalid(self):
+		cache, loaded = self.load(self.write('site.har', b'{"log": {"entries": [{"request": '))
+		self.assertFalse(loaded)
+		self.assertIn('Error reading archive', self.output)
+
+
+
+class TestWarcReader(ArchiveTestCase):
+
+	def create_warc(self, compress=False):
+		records = [
+			warc_record('urn:uuid:1', b'software: test\r\n', warc_type='warcinfo', content_type='application/warc-fields'),
+			warc_record('http://example.com/', b'GET / HTTP/1.1\r\n\r\n', warc_type='request', content_type='application/http; msgtype=request'),
+			warc_record('<http://example.com/>', http_response(200, b'<html>index</html>', [('Content-Type', 'text/html')])),
+			# a record without a length, and with a line that is not a
+			# header, is skipped up to the next record
+			warc_record('http://example.com/nolength', http_response(200, b'lost'), length=False),
+			b'WARC/1.0\r\nnot a header\r\n\r\n',
+			warc_record('http://example.com/old', http_response(302, b'', [('Location', 'http://example.com/new')])),
+			warc_record('http://example.com/new', http_response(200, b'<html>new</html>', [('Content-Type', 'text/html')])),
+			warc_record('http://example.com/bad', b'not http'),
+		]
+		data = b''.join(records)
+		if compress:
+			return self.write('site.warc.gz', gzip.compress(data))
+
+		return self.write('site.warc', data)
+
+
+	def test_read(self):
+		for compress in (False, True):
+			file_name = self.create_warc(compress)
+			with self.subTest(compress=compress):
+				urls = [(url, status, body) for url, status, _, _, body in WarcReader(file_name)]
+				self.assertEqual(urls, [
+					('http://example.com/', 200, b'<html>index</html>'),
+					('http://example.com/old', 302, b''),
+					('http://example.com/new', 200, b'<html>new</html>'),
+				])
+				self.assertIsInstance(open_archive(file_name), WarcReader)
+
+
+	def test_content_encoding(self):
+		block = http_response(200, gzip.compress(b'<html>zipped</html>'), [('Content-Encoding', 'gzip')])
+		file_name = self.write('site.warc', warc_record('http://example.com/', block))
+		self.assertEqual([body for _, _, _, _, body in WarcReader(file_name)], [b'<html>zipped</html>'])
+
+
+	def test_load(self):
+		cache, loaded = self.load(self.create_warc(True))
+		self.assertTrue(loaded)
+		self.assertIs(cache['http://example.com/old'], cache['http://example.com/new'])
+		self.assertEqual(cache.get_num_urls(), 2)
+
+
+	def test_invalid(self):
+		cache, loaded = self.load(self.write('site.warc', b'this is not an archive\r\n'))
+		self.assertFalse(loaded)
+		self.assertIn('Invalid WARC file', self.output)
+
+		cache, loaded = self.load(os.path.join(self.dir.name, 'missing.warc'))
+		self.assertFalse(loaded)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,294 @@
+import sqlite3, tempfile, threading, unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from classes.cache import BodyStore, Cache
+from classes.request import PageFetcher, ResponseBody
+from classes.requester2 import Requester
+from classes.requester_async import AsyncRequester
+
+HOST = 'http://example.com'
+
+
+def create_response(path, body, headers=(), host=HOST):
+	fetcher = PageFetcher(host + path)
+	response_body = ResponseBody()
+	response_body.add(body)
+	headers = [('Content-Type', 'text/html')] + list(headers)
+
+	return fetcher.create_request(fetcher.proto, fetcher.host, fetcher.path, 200, 'OK', headers, response_body)
+
+
+
+class CacheTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.caches = []
+
+
+	def tearDown(self):
+		for cache in self.caches:
+			cache.close()
+		self.dir.cleanup()
+
+
+	def open_cache(self, load=True, save=True, host=HOST + '/'):
+		cache = Cache()
+		cache.cache_dir = self.dir.name
+		cache.set_host(host)
+		cache.open(load, save)
+		self.caches.append(cache)
+
+		return cache
+
+
+	def count_rows(self, table):
+		db = sqlite3.connect(self.dir.name + '/wig.db')
+		try:
+			return db.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+		finally:
+			db.close()
+
+
+
+class TestCache(CacheTestCase):
+
+	def test_save_and_reload(self):
+		cache = self.open_cache(load=False)
+		response = create_response('/index.html', b'<html>index</html>', [('Server', 'test')])
+		cache[HOST + '/index.html'] = response
+		cache[HOST + '/'] = response
+		cache.close()
+
+		cache = self.open_cache(save=False)
+		self.assertIn(HOST + '/', cache)
+		loaded = cache[HOST + '/index.html']
+		self.assertEqual(loaded.body, '<html>index</html>')
+		self.assertEqual(loaded.md5, response.md5)
+		self.assertEqual(loaded.headers['server'], 'test')
+		self.assertEqual(loaded.status['code'], 200)
+
+		# a response stored for several URLs is loaded once
+		self.assertIs(cache[HOST + '/'], loaded)
+		self.assertEqual(cache.get_num_urls(), 1)
+
+		self.assertNotIn(HOST + '/missing', cache)
+		with self.assertRaises(KeyError):
+			cache[HOST + '/missing']
+
+
+	def test_hosts(self):
+		cache = self.open_cache(load=False)
+		cache[HOST + '/'] = create_response('/', b'index')
+		cache.close()
+
+		cache = self.open_cache(host='http://other.com/')
+		self.assertNotIn(HOST + '/', cache)
+
+
+	def test_not_loaded(self):
+		cache = self.open_cache(load=False)
+		cache[HOST + '/'] = create_response('/', b'index')
+		cache.close()
+
+		cache = self.open_cache(load=False)
+		self.assertNotIn(HOST + '/', cache)
+
+
+	def test_expiry(self):
+		cache = self.open_cache(load=False)
+		cache.set(HOST + '/old', create_response('/old', b'old'), ttl=-1)
+		cache.set(HOST + '/etag', create_response('/etag', b'etag', [('ETag', '"v1"')]), ttl=-1)
+		cache.set(HOST + '/new', create_response('/new', b'new'))
+		cache.close()
+
+		cache = self.open_cache()
+		self.assertNotIn(HOST + '/old', cache)
+		self.assertNotIn(HOST + '/etag', cache)
+		self.assertIn(HOST + '/new', cache)
+
+		# only the expired responses with validators are kept
+		self.assertIsNone(cache.get_stale(HOST + '/old'))
+		stale = cache.get_stale(HOST + '/etag')
+		self.assertEqual(stale.body, 'etag')
+		self.assertEqual(stale.get_validators(), {'If-None-Match': '"v1"'})
+		self.assertEqual(self.count_rows('urls'), 2)
+
+
+	def test_shared_bodies(self):
+		# a body served at several URLs is only stored once
+		cache = self.open_cache(load=False)
+		for path in ['/a', '/b', '/c']:
+			cache[HOST + path] = create_response(path, b'<html>not found</html>')
+		cache[HOST + '/d'] = create_response('/d', b'<html>other</html>')
+
+		self.assertEqual(len([key for key in cache.bodies.memory if isinstance(key, str)]), 2)
+		cache.close()
+		self.assertEqual(self.count_rows('responses'), 4)
+		self.assertEqual(self.count_rows('bodies'), 2)
+
+		cache = self.open_cache(save=False)
+		for path in ['/a', '/b', '/c']:
+			self.assertEqual(cache[HOST + path].content, b'<html>not found</html>')
+		self.assertEqual(cache[HOST + '/d'].content, b'<html>other</html>')
+		self.assertEqual(len(cache.bodies.memory), 2)
+
+
+	def test_memory_budget(self):
+		cache = self.open_cache(load=False, save=False)
+		cache.set_memory_budget(1000)
+
+		bodies = {'/%d' % (i, ): bytes([i]) * 300 for i in range(20)}
+		for path, body in bodies.items():
+			cache[HOST + path] = create_response(path, body)
+
+		self.assertLessEqual(cache.bodies.size, 1000)
+		self.assertGreater(len(cache.bodies.spilled), 0)
+		for path, body in bodies.items():
+			self.assertEqual(cache[HOST + path].content, body)
+			self.assertEqual(cache[HOST + path].body, body.decode('utf-8'))
+			self.assertLessEqual(cache.bodies.size, 1000)
+
+
+
+class TestBodyStore(unittest.TestCase):
+
+	def test_spill(self):
+		store = BodyStore(max_size=100)
+		bodies = {i: bytes([i]) * 40 for i in range(10)}
+		for key, body in bodies.items():
+			self.assertTrue(store.add(key, body))
+		self.assertFalse(store.add(0, bodies[0]))
+
+		self.assertLessEqual(store.size, 100)
+		self.assertEqual(set(store.spilled), set(range(8)))
+
+		# bodies are read back in any order, and are only written once
+		for key in [3, 9, 0, 3, 5, 1]:
+			self.assertEqual(store.get(key), bodies[key])
+			self.assertIn(key, store)
+		self.assertEqual(store.spill_file.seek(0, 2), len(store.spilled) * 40)
+
+
+	def test_decoded(self):
+		store = BodyStore(max_size=10)
+		store.add('a', 'café'.encode('utf-8'))
+		store.add('b', b'0123456789')
+		self.assertEqual(store.get_decoded('a', 'utf-8'), 'café')
+		self.assertEqual(store.get_decoded('a', 'latin-1'), 'cafÃ©')
+
+
+	def test_unlimited(self):
+		store = BodyStore()
+		for i in range(10):
+			store.add(i, b'x' * 1000)
+		self.assertIsNone(store.spill_file)
+		self.assertEqual(store.size, 10000)
+
+
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+		if self.headers.get('If-None-Match') == self.server.etag:
+			self.send_response(304)
+			self.send_header('ETag', self.server.etag)
+			self.end_headers()
+			return
+
+		body = self.server.body
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/html')
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('ETag', self.server.etag)
+		self.end_headers()
+		self.wfile.write(body)
+
+
+
+class TestRevalidation(CacheTestCase):
+
+	def setUp(self):
+		super().setUp()
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.server.requests = []
+		self.server.etag = '"v1"'
+		self.server.body = b'<html>v1</html>'
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.host = 'http://127.0.0.1:%d/' % (self.server.server_address[1], )
+
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		super().tearDown()
+
+
+	def fetch(self, engine, cache):
+		options = {'threads': 2, 'concurrency': 2, 'host': self.host, 'max_body_size': None}
+		requester = engine(options, {'cache': cache})
+		try:
+			responses = [response for _, response in requester.stream([[{'url': '/page'}]])]
+		finally:
+			requester.shutdown()
+
+		return responses[0]
+
+
+	def scan(self, engine):
+		# every scan finds the response of the previous one expired
+		cache = self.open_cache(host=self.host)
+		cache.cache_ttl = -1
+		response = self.fetch(engine, cache)
+		cache.close()
+
+		return response
+
+
+	def test_revalidation(self):
+		for engine in (Requester, AsyncRequester):
+			with self.subTest(engine=engine.__name__):
+				self.dir.cleanup()
+				self.dir = tempfile.TemporaryDirectory()
+				self.server.requests = []
+				self.server.etag = '"v1"'
+				self.server.body = b'<html>v1</html>'
+
+				first = self.scan(engine)
+				self.assertEqual(first.body, '<html>v1</html>')
+
+				# the server confirms that the response has not changed
+				second = self.scan(engine)
+				self.assertEqual(second.body, '<html>v1</html>')
+				self.assertEqual(second.id, first.id)
+
+				# the response has changed, so it is replaced
+				self.server.etag = '"v2"'
+				self.server.body = b'<html>v2</html>'
+				third = self.scan(engine)
+				self.assertEqual(third.body, '<html>v2</html>')
+				self.assertEqual(third.status['code'], 200)
+
+				self.assertEqual(self.server.requests, [('/page', None), ('/page', '"v1"'), ('/page', '"v1"')])
+
+
+	def test_fresh_entries_are_not_requested(self):
+		cache = self.open_cache(host=self.host)
+		self.fetch(Requester, cache)
+		cache.close()
+
+		cache = self.open_cache(host=self.host)
+		response = self.fetch(Requester, cache)
+		self.assertEqual(response.body, '<html>v1</html>')
+		self.assertEqual(len(self.server.requests), 1)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
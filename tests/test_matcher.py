@@ -0,0 +1,99 @@
+import os, random, re, unittest
+from classes.fingerprints import Fingerprints
+from classes.matcher import Match, get_required_literal
+from classes.request import Request
+
+# The index only skips fingerprints that cannot match, so matching with
+# the index must give the same results as matching every fingerprint
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setUpModule():
+	global fingerprints, cwd
+	cwd = os.getcwd()
+	os.chdir(ROOT)
+	fingerprints = Fingerprints(snapshot=None)
+
+
+def tearDownModule():
+	os.chdir(cwd)
+
+
+
+def get_parts(fps):
+	# parts of the bodies and headers the fingerprints look for
+	parts = ['<html>', '</div>', 'Version 1.2.3', '4.1', '2014-05-01 "x"', 'x', ' ', '\n']
+	for fp in fps:
+		if 'string' in fp:
+			parts.append(fp['string'])
+		if 'regex' in fp:
+			parts.append(get_required_literal(fp['regex']))
+			parts.append(re.sub(r'[\\()\[\]^$?*+|]', '', fp['regex']))
+
+	return parts
+
+
+def create_response(rand, fps, parts):
+	response = Request()
+	response.url = '/'
+	response.status = {'code': rand.choice([200, 200, 404])}
+
+	content_type = rand.choice(['text/html', 'application/javascript', 'image/png', None])
+	if content_type is not None:
+		response.headers['content-type'] = content_type
+
+	for fp in rand.sample(fps, 3):
+		if fp['type'] == 'header':
+			response.headers[fp['header'].lower()] = ''.join(rand.choice(parts) for _ in range(3))
+
+	response.set_body(''.join(rand.choice(parts) for _ in range(rand.randint(0, 40))).encode('utf-8'))
+
+	md5s = [fp['md5'] for fp in fps if fp['type'] == 'md5']
+	response.md5 = rand.choice(md5s) if md5s and rand.random() < 0.5 else '0' * 32
+
+	return response
+
+
+
+class TestFingerprintIndex(unittest.TestCase):
+
+	def assert_same_results(self, fps, count, seed=0):
+		rand = random.Random(seed)
+		indexed = Match()
+		linear = Match()
+		linear.index_threshold = len(fps) + 1
+		parts = get_parts(fps)
+
+		found = 0
+		for i in range(count):
+			response = create_response(rand, fps, parts)
+			matches = indexed.get_result(fps, response)
+			self.assertEqual(matches, linear.get_result(fps, response))
+			found += len(matches) > 0
+
+		# the responses must match something, or nothing is tested
+		self.assertGreater(found, count // 10)
+
+
+	def test_all_fingerprints(self):
+		self.assert_same_results(fingerprints.get_all() + fingerprints.get_url_less(), 300)
+
+
+	def test_url_less(self):
+		self.assert_same_results(fingerprints.get_url_less(), 500)
+
+
+	def test_javascript(self):
+		self.assert_same_results(fingerprints.get_js_fingerprints(), 300)
+
+
+	def test_urls(self):
+		for fps in fingerprints.get_ordered_list():
+			if len(fps) >= Match().index_threshold:
+				self.assert_same_results(fps, 20)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
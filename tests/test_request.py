@@ -0,0 +1,75 @@
+import hashlib, os, random, re, unittest
+from classes.request import clean_404, clean_page_404
+
+ERROR_PAGES = os.path.join(os.path.dirname(__file__), 'data', 'error_pages')
+
+
+def clean_404_cascade(page):
+	# the substitutions that were used before clean_404, in the same order.
+	# The pattern for windows paths did not match anything, as '\\[' was
+	# read as a literal '[', and two dates were replaced with a str, which
+	# fails for bytes. Both are fixed here
+	page = re.sub(rb'(\d?\d:?){2,3}', b'', page)
+	page = re.sub(rb'AM', b'', page, flags=re.IGNORECASE)
+	page = re.sub(rb'PM', b'', page, flags=re.IGNORECASE)
+
+	page = re.sub(rb'(\d){8}', b'', page)
+	page = re.sub(rb'\d{4}-\d{2}-\d{2}', b'', page)
+	page = re.sub(rb'\d{4}/\d{2}/\d{2}', b'', page)
+	page = re.sub(rb'\d{2}-\d{2}-\d{4}', b'', page)
+	page = re.sub(rb'\d{2}/\d{2}/\d{4}', b'', page)
+
+	page = re.sub(rb'(\d){6}', b'', page)
+	page = re.sub(rb'\d{2}-\d{2}-\d{2}', b'', page)
+	page = re.sub(rb'\d{2}/\d{2}/\d{2}', b'', page)
+
+	page = re.sub(rb'/[^ ]+', b'', page)
+	page = re.sub(rb'[a-zA-Z]:\\[^ ]+', b'', page)
+
+	return page
+
+
+
+class TestCleanPage404(unittest.TestCase):
+
+	def test_error_pages(self):
+		for name in sorted(os.listdir(ERROR_PAGES)):
+			with open(os.path.join(ERROR_PAGES, name), 'rb') as fh:
+				page = fh.read()
+
+			with self.subTest(page=name):
+				self.assertEqual(clean_404(page), clean_404_cascade(page))
+				self.assertEqual(clean_page_404(page), hashlib.md5(clean_404_cascade(page)).hexdigest())
+
+
+	def test_words(self):
+		# removing a part can create a new match, and a path or windows
+		# path that is empty after the times are removed is kept
+		for page, cleaned in [
+				(b'/404 ', b'/ '),
+				(b'x /pm', b'x /'),
+				(b'/12:30pm/ ', b' '),
+				(b'C:\\12 x', b'C:\\ x'),
+				(b'PAMM', b''),
+				(b'A12M', b''),
+				(b'Exam:\\logs', b'E'),
+				(b'1am2pm3am4pm5am6am7am8 x', b' x'),
+				(b'at 3:07pm', b'at '),
+				(b'</p>\n<p>', b'<')]:
+			with self.subTest(page=page):
+				self.assertEqual(clean_404(page), cleaned)
+				self.assertEqual(clean_404_cascade(page), cleaned)
+
+
+	def test_random_pages(self):
+		# short pages made of the characters the substitutions match
+		rand = random.Random(0)
+		alphabet = b'0123456789:/\\ -aApPmMxC\n'
+		for i in range(20000):
+			page = bytes(rand.choice(alphabet) for j in range(rand.randint(0, 30)))
+			self.assertEqual(clean_404(page), clean_404_cascade(page), page)
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,268 @@
+import json, os, random, unittest
+from fractions import Fraction
+from classes.fingerprints import Fingerprints
+from classes.matcher import Match
+from classes.probeplan import ProbePlan
+from classes.results import Results
+from classes.scheduler import ProbeScheduler, VersionScheduler
+
+# The schedulers are run against simulated sites, which run a version of
+# a CMS from the fingerprint database, and only serve the files of that
+# version. Every other URL is missing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setUpModule():
+	# the fingerprints are loaded from 'data/', as when wig is run, but
+	# without writing a snapshot into the source tree
+	global fingerprints, cwd
+	cwd = os.getcwd()
+	os.chdir(ROOT)
+	fingerprints = Fingerprints(snapshot=None)
+
+
+def tearDownModule():
+	os.chdir(cwd)
+
+
+
+class Printer(object):
+	def print(self, *args, **kwargs):
+		pass
+
+
+class Response(object):
+	def __init__(self, code):
+		self.status = {'code': code}
+
+
+def get_versions(cms):
+	return sorted({fp['output'] for fps in fingerprints.get_fingerprints_for_cms(cms) for fp in fps if fp['type'] == 'md5'})
+
+
+def get_string_urls(cms):
+	# the URLs with string or regex fingerprints of the cms
+	return [fps[0]['url'] for fps in fingerprints.get_fingerprints_for_cms(cms) if not all(fp['type'] == 'md5' for fp in fps)]
+
+
+def get_sites(per_cms, seed=1):
+	rand = random.Random(seed)
+	sites = []
+	for cms in sorted(fingerprints.cms_index):
+		versions = get_versions(cms)
+		for version in rand.sample(versions, min(per_cms, len(versions))):
+			sites.append((cms, version))
+
+	return sites
+
+
+def get_matches(fps, cms, version):
+	# the fingerprints that match the file the site serves at the URL.
+	# Other versions, and other CMSs, might have the same file
+	md5 = next((fp['md5'] for fp in fps if fp['type'] == 'md5' and fp['cms'] == cms and fp['output'] == version), None)
+	if md5 is None:
+		return []
+
+	return [fp for fp in fps if fp['type'] == 'md5' and fp['md5'] == md5]
+
+
+def get_cms_results(fps_list, cms, version):
+	results = Results({'printer': Printer()})
+	for fps in fps_list:
+		for fp in get_matches(fps, cms, version):
+			results.add_cms(fp)
+
+	return results
+
+
+
+class TestProbeScheduler(unittest.TestCase):
+
+	def count_requests(self, cms, version, prioritize=False, gain=True):
+		# the number of requests until the cms is detected
+		scheduler = ProbeScheduler(fingerprints, Match()) if gain else None
+		if prioritize:
+			scheduler.prioritize([cms])
+
+		order = scheduler if gain else fingerprints.get_ordered_list()
+		for requests, fps in enumerate(order, 1):
+			matches = [fp for fp in get_matches(fps, cms, version) if fp['cms'] == cms]
+			if matches:
+				return requests
+
+			if gain:
+				scheduler.update(fps, Response(404), [])
+
+		return None
+
+
+	def test_gain_order_beats_fixed_order(self):
+		sites = get_sites(3)
+		gain = [self.count_requests(cms, version) for cms, version in sites]
+		fixed = [self.count_requests(cms, version, gain=False) for cms, version in sites]
+
+		self.assertNotIn(None, gain)
+		self.assertLess(sum(gain) / len(gain), sum(fixed) / len(fixed))
+
+
+	def test_common_files_first(self):
+		# the file that most versions of a cms have is requested in the
+		# first round over the CMSs, e.g. /misc/druplicon.png for Drupal
+		for version in ['5.0', '6.20', '7.31']:
+			self.assertLessEqual(self.count_requests('Drupal', version), len(fingerprints.cms_index))
+
+
+	def test_prioritize(self):
+		# the cms is detected by the first URLs that are requested for it:
+		# its string and regex URLs, and its most common files
+		for cms, version in get_sites(1):
+			first = len(get_string_urls(cms)) + ProbeScheduler.priority_urls
+			self.assertLessEqual(self.count_requests(cms, version, prioritize=True), first, cms)
+
+
+	def test_prioritize_string_only_site(self):
+		# the site only matches a string or regex of the cms, e.g. the
+		# version in /readme.html, while every md5 URL is missing
+		for cms in sorted(fingerprints.cms_index):
+			urls = get_string_urls(cms)
+			for url in urls:
+				scheduler = ProbeScheduler(fingerprints, Match())
+				scheduler.prioritize([cms])
+				for requests, fps in enumerate(scheduler, 1):
+					if fps[0]['url'] == url:
+						break
+					scheduler.update(fps, Response(404), [])
+
+				self.assertLessEqual(requests, len(urls), (cms, url))
+
+
+	def test_existing_pages_restore_weights(self):
+		scheduler = ProbeScheduler(fingerprints, Match())
+		order = iter(scheduler)
+		fps = next(order)
+		weights = dict(scheduler.weights)
+
+		scheduler.update(fps, Response(200), [])
+		for cms, _, _ in scheduler.stats[fps[0]['url']]:
+			self.assertGreater(scheduler.weights[cms], weights[cms])
+
+		scheduler.update(fps, Response(200), fps[:1])
+		self.assertEqual(scheduler.weights[fps[0]['cms']], 0)
+
+
+
+class TestVersionScheduler(unittest.TestCase):
+
+	def run_scheduler(self, cms, version, window):
+		# returns the results and the number of requests
+		scheduler = VersionScheduler(fingerprints.get_fingerprints_for_cms(cms))
+		results = Results({'printer': Printer()})
+		order = iter(scheduler)
+
+		pending = []
+		requests = 0
+		while True:
+			while len(pending) < window:
+				fps = next(order, None)
+				if fps is None: break
+				pending.append(fps)
+
+			if not pending:
+				break
+
+			fps = pending.pop(0)
+			requests += 1
+
+			matches = get_matches(fps, cms, version)
+			for fp in matches:
+				results.add_cms(fp)
+			scheduler.update(fps, Response(200 if matches else 404), matches)
+
+		return results, requests
+
+
+	def test_same_result_as_exhaustive(self):
+		requests = exhaustive = 0
+		for cms, version in get_sites(3, seed=2):
+			fps_list = fingerprints.get_fingerprints_for_cms(cms)
+			expected = get_cms_results(fps_list, cms, version).get_results()['CMS'][cms]
+
+			for window in (1, 10):
+				results, count = self.run_scheduler(cms, version, window)
+				self.assertEqual(results.get_results()['CMS'][cms], expected, (cms, version, window))
+				self.assertIn(version, expected)
+
+				requests += count
+				exhaustive += len(fps_list)
+
+		self.assertLess(requests, exhaustive / 2)
+
+
+
+class TestConfidence(unittest.TestCase):
+
+	def test_no_matches(self):
+		results = Results({'printer': Printer()})
+		self.assertEqual(results.confidence('WordPress'), 0)
+		self.assertFalse(results.found_match('WordPress'))
+
+
+	def test_scores(self):
+		fp = {'url': '/a', 'cms': 'cms', 'type': 'md5', 'md5': 'x'}
+		results = Results({'printer': Printer()})
+
+		# a file shared by two versions does not tell them apart
+		results.add_cms(dict(fp, output='1.0'))
+		results.add_cms(dict(fp, output='1.1'))
+		self.assertEqual(results.confidence('cms'), 0)
+		self.assertTrue(results.found_match('cms'))
+
+		# 1.0: 1/2 + 1, 1.1: 1/2
+		results.add_cms(dict(fp, url='/b', output='1.0'))
+		self.assertAlmostEqual(results.confidence('cms'), 1 - Fraction(1, 2) / Fraction(3, 2))
+		self.assertEqual(results.get_results()['CMS']['cms'], ['1.0'])
+
+
+	def test_recorded_versions(self):
+		for cms, version in get_sites(2, seed=3):
+			results = get_cms_results(fingerprints.get_fingerprints_for_cms(cms), cms, version)
+			best = results.get_results()['CMS'][cms]
+
+			self.assertIn(version, best)
+			if len(best) == 1:
+				self.assertGreater(results.confidence(cms), 0)
+			else:
+				self.assertEqual(results.confidence(cms), 0)
+
+
+
+class TestProbePlan(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.plan = ProbePlan(fingerprints)
+		cls.plan.create()
+
+
+	def test_checked_in_plan_is_current(self):
+		with open('data/probe_plan.json') as fh:
+			saved = json.load(fh)
+
+		self.assertEqual(json.loads(json.dumps(self.plan.plan)), saved)
+
+
+	def test_same_result_as_exhaustive(self):
+		for cms, version in get_sites(5, seed=4):
+			fps_list = fingerprints.get_fingerprints_for_cms(cms)
+			urls = set(self.plan.plan[cms]['urls'])
+			plan = [fps for fps in fps_list if fps[0]['url'] in urls]
+
+			expected = get_cms_results(fps_list, cms, version).get_results()['CMS'][cms]
+			results = get_cms_results(plan, cms, version).get_results()['CMS'][cms]
+			self.assertEqual(results, expected, (cms, version))
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -9,19 +9,23 @@ from classes.fingerprints import Fingerprints
 from classes.discovery import DiscoverCMS, DiscoverVersion
 from classes.discovery import DiscoverOS, DiscoverJavaScript, DiscoverAllCMS
 from classes.discovery import DiscoverRedirect, DiscoverErrorPage, DiscoverMore
-from classes.discovery import DiscoverInteresting, DiscoverUrlLess
+from classes.discovery import DiscoverInteresting, DiscoverUrlLess, DiscoverPassive
 from classes.headers import ExtractHeaders
 from classes.matcher import Match
 from classes.printer import Printer
 from classes.output import Output
 from classes.requester2 import Requester
+from classes.requester_async import AsyncRequester
+from classes.requester_offline import OfflineRequester
+from classes.archive import ArchiveLoader
+from classes.postprocessor import PostProcessor
 
 
 
 
 class Wig(object):
 
-	def __init__(self, host, verbosity, stop_after=1, run_all=False, match_all=False, no_load_cache=False, no_save_cache=False):
+	def __init__(self, host, verbosity, stop_after=1, run_all=False, match_all=False, no_load_cache=False, no_save_cache=False, engine='thread', concurrency=100, max_body_size=2*1024*1024, error_page_distance=None, cache_memory=256, archive=None, probe_order='gain', version_detection='adaptive', confidence_margin=0.5):
 		c = Color()
 
 		self.options = {
@@ -29,12 +33,20 @@ class Wig(object):
 			'verbosity': verbosity,
 			'printer': Printer(verbosity, c),
 			'threads': 10,
-			'chunk_size': 10, # same as threads
 			'run_all': run_all,
 			'match_all': match_all,
 			'stop_after': stop_after,
 			'no_cache_load': no_load_cache,
 			'no_cache_save': no_save_cache,
+			'engine': engine,
+			'concurrency': concurrency,
+			'max_body_size': max_body_size,
+			'error_page_distance': error_page_distance,
+			'cache_memory': cache_memory,
+			'archive': archive,
+			'probe_order': probe_order,
+			'version_detection': version_detection,
+			'confidence_margin': confidence_margin,
 		}
 
 		self.data = {
@@ -53,8 +65,19 @@ class Wig(object):
 		# PRE PROCESSING
 		########################################################################
 
+		# when fingerprinting from an archive, the cache is filled from
+		# the archive first, and no requests are made at all
+		if self.options['archive'] is not None:
+			self.data['cache'].set_host(self.options['host'])
+			self.data['cache'].set_memory_budget(self.options['cache_memory']*1024*1024)
+			if not ArchiveLoader(self.options, self.data).run():
+				sys.exit(1)
+
+			dr = DiscoverRedirect(self.options, self.data['cache'])
+
 		# check if the input URL redirects to somewhere else
-		dr = DiscoverRedirect(self.options)
+		else:
+			dr = DiscoverRedirect(self.options)
 
 		# make sure that the input is valid
 		if dr.get_valid_url() is None:
@@ -77,11 +100,16 @@ class Wig(object):
 
 		# load cache if this is not disabled
 		self.data['cache'].set_host(self.options['host'])
-		if not self.options['no_cache_load']:
-			self.data['cache'].load()
+		self.data['cache'].set_memory_budget(self.options['cache_memory']*1024*1024)
+		self.data['cache'].open(not self.options['no_cache_load'], not self.options['no_cache_save'])
 
 		# set a requester instance to use for all the requests
-		self.data['requester'] = Requester(self.options, self.data)
+		if self.options['archive'] is not None:
+			self.data['requester'] = OfflineRequester(self.options, self.data)
+		elif self.options['engine'] == 'async':
+			self.data['requester'] = AsyncRequester(self.options, self.data)
+		else:
+			self.data['requester'] = Requester(self.options, self.data)
 
 		# find error pages
 		find_error = DiscoverErrorPage(self.options, self.data)
@@ -89,13 +117,17 @@ class Wig(object):
 		self.data['error_pages'] = find_error.get_error_pages()
 
 		# create a matcher
-		self.data['matcher'].set_404s(self.data['error_pages'])
+		self.data['matcher'].set_404s(self.data['error_pages'], find_error.get_error_simhashes(), self.options['error_page_distance'])
 
 		########################################################################
 		# PROCESSING
 		########################################################################
 		cms_finder = DiscoverCMS(self.options, self.data)
 		version_finder = DiscoverVersion(self.options, self.data)
+
+		# request the URLs of the CMSs that the responses so far point to first
+		passive = DiscoverPassive(self.options, self.data)
+		cms_finder.prioritize(passive.run([dr.get_response()] + find_error.get_responses()))
 		p = self.options['printer']
 
 		# as long as there are more fingerprints to check, and
@@ -122,24 +154,36 @@ class Wig(object):
 				else:
 					pass
 
+		# cancel the remaining CMS detection requests
+		cms_finder.stop()
+
 		########################################################################
 		# POST PROCESSING
 		########################################################################
 
 		# find interesting files
 		DiscoverInteresting(self.options, self.data). run()
-		DiscoverMore(self.options, self.data).run()
-		ExtractHeaders(self.data).run()
-		DiscoverJavaScript(self.options, self.data).run()
-		DiscoverUrlLess(self.options, self.data).run()
+
+		# the remaining stages examine the responses in the cache.
+		# The crawler is added first, as the resources it fetches
+		# should be examined by the other stages
+		post_processor = PostProcessor(self.data)
+		post_processor.add_visitor(DiscoverMore(self.options, self.data))
+		post_processor.add_visitor(ExtractHeaders(self.data))
+		post_processor.add_visitor(DiscoverJavaScript(self.options, self.data))
+		post_processor.add_visitor(DiscoverUrlLess(self.options, self.data))
 		
 		if self.options['match_all']:
-			DiscoverAllCMS(self.data).run()
+			post_processor.add_visitor(DiscoverAllCMS(self.data))
 
-		DiscoverOS(self.options, self.data).run()
+		post_processor.add_visitor(DiscoverOS(self.options, self.data))
+		post_processor.run()
 
-		if not self.options['no_cache_save']:
-			self.data['cache'].save()
+		# all requests have been made
+		self.data['requester'].shutdown()
+
+		# the responses have been saved as they arrived
+		self.data['cache'].close()
 	
 		########################################################################
 		# RESULT PRINTING
@@ -173,6 +217,33 @@ if __name__ == '__main__':
 	parser.add_argument('-N', action='store_true', dest='no_cache', default=False,
 						help='Shortcut for --no_cache_load and --no_cache_save')
 
+	parser.add_argument('--engine', choices=['thread', 'async'], default='thread',
+						help='Make the requests from threads or from an asyncio event loop. Default: thread')
+
+	parser.add_argument('--concurrency', type=int, default=100,
+						help='The max number of requests in flight when using the async engine, while requesting the interesting files and the extracted links. CMS and version detection stop early, and keep as many requests in flight as there are threads. Default: 100')
+
+	parser.add_argument('--max_body_size', type=int, default=2*1024*1024,
+						help='Only keep this many bytes of a response body. The md5 is still calculated over the whole body. Default: 2097152')
+
+	parser.add_argument('--error_page_distance', type=int, default=None,
+						help='Also treat pages as error pages if their simhash differs from that of an error page in at most this many bits (of 64). This detects error pages that change between requests. 12 is a good value. Default: only identical error pages')
+
+	parser.add_argument('--cache_memory', type=int, default=256,
+						help='The max number of MB of response bodies to keep in memory. Bodies that have not been used recently are moved to a temporary file. Default: 256')
+
+	parser.add_argument('--archive', default=None, metavar='FILE',
+						help='Fingerprint the host from the responses in a HAR or WARC file (.warc or .warc.gz) instead of making requests. Implies -N')
+
+	parser.add_argument('--probe_order', choices=['gain', 'fixed'], default='gain',
+						help='The order of the requests for CMS detection: request the URLs most likely to identify a CMS first, based on the fingerprints and the responses so far, or take one URL from each CMS in turn. Default: gain')
+
+	parser.add_argument('--version_detection', choices=['adaptive', 'plan', 'exhaustive'], default='adaptive',
+						help='Only request the URLs needed to tell the versions of a detected CMS apart, request the URLs in the probe plan (data/probe_plan.json) at once, or request all the URLs of the CMS. Default: adaptive')
+
+	parser.add_argument('--confidence_margin', type=float, default=0.5,
+						help='Stop version detection once the best version is ahead of the second best by this fraction of its score (0.5: the best scores at least twice as high). 1 only stops when no other version matches. Not used with exhaustive version detection. Default: 0.5')
+
 	parser.add_argument('--verbosity', '-v', action='count', help='Increase verbosity. Use twice for even more info')
 
 	parser.add_argument('-e',   action='store_true', dest='enumerate', default=False,
@@ -181,7 +252,7 @@ if __name__ == '__main__':
 
 	args = parser.parse_args()
 
-	if args.no_cache:
+	if args.no_cache or args.archive is not None:
 		args.no_cache_load = True
 		args.no_cache_save = True
 
@@ -191,11 +262,12 @@ if __name__ == '__main__':
 		verbosity = args.verbosity
 
 
+	wig = None
 	try:
-		wig = Wig(args.host, verbosity, args.stop_after, args.run_all, args.match_all, args.no_cache_load, args.no_cache_save)
+		wig = Wig(args.host, verbosity, args.stop_after, args.run_all, args.match_all, args.no_cache_load, args.no_cache_save, args.engine, args.concurrency, args.max_body_size, args.error_page_distance, args.cache_memory, args.archive, args.probe_order, args.version_detection, args.confidence_margin)
 		wig.run()
 	except KeyboardInterrupt:
 		# detect ctrl+c
-		for w in wig.workers:
-			w.kill = True
+		if wig is not None and 'requester' in wig.data:
+			wig.data['requester'].kill()
 		raise